@@ -0,0 +1,244 @@
+"""
+Offline end to end benchmark for gadget tasks
+
+Starts local fake Bitbucket, Artifactory and Kubernetes servers (see
+benchmarks/fakes.py), points a throwaway gadget.yaml and kubeconfig at them
+and times the real tasks in fresh `gadget` processes:
+
+    python benchmarks/e2e.py --rounds 3 --output e2e.json
+    python benchmarks/e2e.py --scale full --latency 20 --scenario list-repos
+    python benchmarks/e2e.py --baseline e2e.json --threshold 1.25
+
+The `full` scale serves 10k repos, 1M artifacts and 5k pods. Use
+--artifacts to size the purge scenario separately, deleting a million
+artifacts takes a long time even against a local server.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakes import Dataset, FakeServer  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCALES = {
+    'small': dict(repos=1000, artifacts=10000, namespaces=50, pods=500, jobs=100),
+    'full': dict(repos=10000, artifacts=1000000, namespaces=250, pods=5000, jobs=500),
+}
+
+# Scenario name -> gadget arguments
+SCENARIOS = {
+    'list-repos': ['bitbucket.list-repos', 'bench'],
+    'get-users': ['bitbucket.get-users', 'bench'],
+    'get-permissions': ['bitbucket.get-permissions', 'bench'],
+    'get-branches': ['bitbucket.get-branches', 'bench/repo-00001'],
+    'prune-branches': ['bitbucket.prune-branches', 'bench/*', '180', '--repos', 'repo'],
+    'reconcile-branch-checks': ['bitbucket.reconcile-branch-checks', 'bench/*', '--repos', 'repo'],
+    'sync-permissions': ['bitbucket.sync-permissions', 'bench'],
+    'set-repo-groups': ['bitbucket.set-repo-groups', 'bench/*', 'cloud', '--repos', 'repo'],
+    'artifact-cleanup': ['artifactory.artifact-cleanup', 'libs-release', '2021-01-01T00:00:00.000Z', '--purge'],
+    'container-cleanup': ['artifactory.container-cleanup', 'docker-release', '2021-01-01T00:00:00.000Z', '--purge'],
+    'docker-retention': ['artifactory.docker-retention', 'docker-release', '--keep', '5', '--purge'],
+    'folder-cleanup': ['artifactory.folder-cleanup', 'docker-release'],
+    'audit-namespaces': ['kubernetes.audit-namespaces', '1'],
+    'cleanup-jobs': ['kubernetes.cleanup-jobs', '1', '--purge'],
+}
+
+METRICS = ('seconds', 'task_seconds', 'http_calls', 'server_requests')
+
+KUBECONFIG = """
+apiVersion: v1
+kind: Config
+clusters:
+- name: bench
+  cluster: {{server: "{url}"}}
+users:
+- name: bench
+  user: {{token: bench}}
+contexts:
+- name: saas-dev-product-aks-green-admin
+  context: {{cluster: bench, user: bench}}
+current-context: saas-dev-product-aks-green-admin
+"""
+
+
+def workdir(url):
+    """
+    Writes a gadget.yaml and kubeconfig pointing at the fake server
+
+    :param url: string, The fake server url
+    :return string: The working directory for the benchmark runs
+    """
+
+    path = tempfile.mkdtemp(prefix='gadget-bench-')
+    conf = {
+        'bitbucket': {'url': url, 'username': 'bench', 'password': 'bench'},
+        'artifactory': {'server': url, 'username': 'bench', 'password': 'bench'},
+        'confluence': {'username': 'bench', 'password': 'bench'},
+    }
+
+    with open(os.path.join(path, 'gadget.yaml'), 'w') as fh:
+        fh.write(json.dumps(conf, indent=2))
+
+    with open(os.path.join(path, 'kubeconfig'), 'w') as fh:
+        fh.write(KUBECONFIG.format(url=url))
+
+    return path
+
+
+def run(server, path, name, python=None):
+    """
+    Runs one scenario in a fresh gadget process
+
+    :param server: FakeServer, The fake server
+    :param path: string, The benchmark working directory
+    :param name: string, The scenario name
+    :param python: string, Interpreter to run gadget with
+    :return dict: The timings of the run
+    """
+
+    metrics_file = os.path.join(path, f"{name}.metrics.json")
+    env = dict(
+        os.environ,
+        HOME=path,
+        KUBECONFIG=os.path.join(path, 'kubeconfig'),
+        GADGET_CACHE_DIR=os.path.join(path, 'cache'),
+        PYTHONPATH=os.pathsep.join(filter(None, [ROOT, os.environ.get('PYTHONPATH')])),
+    )
+    env.pop('GADGET_SOCKET', None)
+
+    server.reset_stats()
+    start = time.perf_counter()
+    process = subprocess.run(
+        [python or sys.executable, '-m', 'gadget', '--no-cache', '--metrics', metrics_file] + SCENARIOS[name],
+        cwd=path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+    )
+    seconds = time.perf_counter() - start
+    stats = server.reset_stats()
+
+    result = {
+        'seconds': seconds,
+        'task_seconds': 0.0,
+        'http_calls': 0,
+        'server_requests': sum(stats.values()),
+        'server': stats,
+        'error': None if process.returncode == 0 else process.stderr.decode('utf-8', 'replace')[-2000:],
+    }
+
+    if os.path.exists(metrics_file):
+        with open(metrics_file, 'r') as fh:
+            data = json.load(fh)
+
+        result['task_seconds'] = sum(
+            entry['seconds'] for task_name, entry in data['tasks'].items() if not task_name.endswith('.init')
+        )
+        result['http_calls'] = sum(entry['calls'] for entry in data['http'].values())
+        result['items'] = data['items']
+
+    return result
+
+
+def summarize(rounds):
+    """
+    :param rounds: list, Results of `run` keyed on scenario, one dict per round
+    :return dict: Median of every metric keyed on scenario
+    """
+
+    summary = {}
+
+    for name in rounds[0]:
+        items = [results[name] for results in rounds]
+        summary[name] = {metric: statistics.median([item[metric] for item in items]) for metric in METRICS}
+        summary[name]['server'] = items[-1]['server']
+        summary[name]['items'] = items[-1].get('items', {})
+        summary[name]['error'] = items[-1]['error']
+
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    """
+    :param summary: dict, The current summary
+    :param baseline: dict, A summary saved by a previous run
+    :param threshold: float, Allowed ratio of current to baseline wall time
+    :return list: Descriptions of every regression found
+    """
+
+    regressions = []
+
+    for name, current in summary.items():
+        previous = baseline.get(name)
+
+        if previous is None:
+            continue
+
+        if current['error'] and not previous['error']:
+            regressions.append(f"{name}: now fails")
+        elif previous['seconds'] and current['seconds'] > previous['seconds'] * threshold:
+            regressions.append(f"{name}: {current['seconds']:.2f}s vs baseline {previous['seconds']:.2f}s")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--scenario', action='append', dest='scenarios', choices=sorted(SCENARIOS),
+                        help="Limit to a scenario, repeatable")
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--repos', type=int, help="Override the number of repos")
+    parser.add_argument('--artifacts', type=int, help="Override the number of artifacts")
+    parser.add_argument('--pods', type=int, help="Override the number of pods")
+    parser.add_argument('--latency', type=float, default=0, help="Added latency per request in ms")
+    parser.add_argument('--python', help="Interpreter to run gadget with, defaults to the current one")
+    parser.add_argument('--output', help="Write the json summary to this file")
+    parser.add_argument('--baseline', help="A json summary to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+
+    sizes = dict(SCALES[args.scale])
+    sizes.update({key: value for key, value in vars(args).items() if key in sizes and value is not None})
+
+    server = FakeServer(Dataset(**sizes), latency=args.latency / 1000.0).start()
+    path = workdir(server.url)
+    names = args.scenarios or sorted(SCENARIOS)
+
+    rounds = [{name: run(server, path, name, python=args.python) for name in names} for _ in range(args.rounds)]
+    summary = summarize(rounds)
+    server.shutdown()
+
+    for name, item in summary.items():
+        status = f"error={item['error'].strip().splitlines()[-1]}" if item['error'] else ''
+        print(f"{name:<20}{item['seconds']:>9.2f} s{item['task_seconds']:>9.2f} s task"
+              f"{item['server_requests']:>9.0f} reqs  {status}")
+
+    document = json.dumps({'rounds': args.rounds, 'sizes': sizes, 'latency_ms': args.latency, 'scenarios': summary}, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(document)
+    else:
+        print(document)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)['scenarios']
+
+        regressions = compare(summary, baseline, args.threshold)
+
+        for item in regressions:
+            print(f"REGRESSION {item}", file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
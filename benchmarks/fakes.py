@@ -0,0 +1,470 @@
+"""
+Local stand-ins for the services gadget talks to, used by the offline
+benchmarks. One threaded HTTP server answers:
+
+    /2.0/...          Bitbucket 2.0 (paginated `values`/`next`) and 1.0 group privileges
+    /artifactory/...  Artifactory AQL search, storage info and listings, deletes
+    /api/v1/...       Kubernetes core list APIs (namespaces, pods)
+    /apis/batch/v1/.. Kubernetes job list and delete
+
+Every object is synthesized from its index, so a workspace of 10k repos or
+a repository of 1M artifacts costs no memory until it is requested.
+"""
+import json
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlparse, parse_qs
+
+CREATED = '2020-01-01T00:00:00.000000+00:00'
+ART_DATE = '2020-01-01T00:00:00.000Z'
+KUBE_DATE = '2020-01-01T00:00:00Z'
+LANGUAGES = ('java', 'javascript', 'python')
+
+
+class Dataset:
+    """
+    Sizes of the synthetic workspace, repository and cluster
+
+    :param repos: int, Bitbucket repositories in the workspace
+    :param users: int, Workspace members
+    :param repo_users: int, Explicit user permissions per repository
+    :param branches: int, Branches per repository
+    :param artifacts: int, Artifacts matched by an AQL search
+    :param namespaces: int, Kubernetes namespaces
+    :param pods: int, Kubernetes pods, spread over the namespaces
+    :param jobs: int, Kubernetes jobs, every other one failed
+    """
+
+    def __init__(self, repos=10000, users=200, repo_users=3, branches=25, artifacts=1000000,
+                 namespaces=250, pods=5000, jobs=500):
+        self.repos = repos
+        self.users = users
+        self.repo_users = repo_users
+        self.branches = branches
+        self.artifacts = artifacts
+        self.namespaces = namespaces
+        self.pods = pods
+        self.jobs = jobs
+
+    #
+    # Bitbucket
+    #
+    def repo(self, workspace, num):
+        name = f"repo-{num:05d}"
+        return {
+            'type': 'repository',
+            'uuid': f"{{00000000-0000-0000-0000-{num:012d}}}",
+            'name': name,
+            'slug': name,
+            'full_name': f"{workspace}/{name}",
+            'language': LANGUAGES[num % len(LANGUAGES)],
+            'created_on': CREATED,
+            'updated_on': CREATED,
+            'is_private': True,
+            'project': {'type': 'project', 'key': f"P{num % 50:02d}", 'name': f"Project {num % 50}"},
+            'mainbranch': {'type': 'branch', 'name': 'develop'},
+            'links': {'clone': [
+                {'name': 'https', 'href': f"https://bitbucket.org/{workspace}/{name}.git"},
+                {'name': 'ssh', 'href': f"git@bitbucket.org:{workspace}/{name}.git"},
+            ]},
+        }
+
+    def user(self, num):
+        return {
+            'type': 'user',
+            'uuid': f"{{10000000-0000-0000-0000-{num:012d}}}",
+            'account_id': f"account-{num:05d}",
+            'display_name': f"User {num:05d}",
+            'nickname': f"user{num:05d}",
+        }
+
+    def workspace_permission(self, workspace, num):
+        return {
+            'type': 'workspace_membership',
+            'permission': 'owner' if num == 0 else 'member',
+            'user': self.user(num),
+            'workspace': {'slug': workspace},
+        }
+
+    def repo_permission(self, workspace, num):
+        repo = self.repo(workspace, num // self.repo_users)
+        return {
+            'type': 'repository_permission',
+            'permission': ('admin', 'write', 'read')[num % 3],
+            'user': self.user((num * 7) % self.users),
+            'repository': {'type': 'repository', 'name': repo['name'], 'full_name': repo['full_name'], 'uuid': repo['uuid']},
+        }
+
+    def branch(self, num):
+        day = 1 + num % 28
+        return {
+            'type': 'branch',
+            'name': 'develop' if num == 0 else f"feature/item-{num:04d}",
+            'target': {
+                'hash': f"{num:040x}",
+                'date': f"2020-{1 + num % 12:02d}-{day:02d}T00:00:00+00:00",
+                'author': {'raw': f"User {num % self.users:05d} <user{num % self.users:05d}@example.com>"},
+            },
+        }
+
+    #
+    # Artifactory
+    #
+    def artifact(self, repo, num, docker=False):
+        if docker:
+            path, name = f"app-{num // 100:05d}/1.0.{num % 100}", 'manifest.json'
+        else:
+            path, name = f"org/app-{num // 1000:04d}/{num % 1000}", f"app-{num}.jar"
+
+        return {
+            'repo': repo, 'path': path, 'name': name, 'type': 'file', 'size': 1024 + num % 4096,
+            'created': ART_DATE, 'created_by': 'ci', 'modified': ART_DATE, 'modified_by': 'ci', 'updated': ART_DATE,
+        }
+
+    #
+    # Kubernetes
+    #
+    def namespace(self, num):
+        return {
+            'metadata': {
+                'name': f"ns-{num:04d}",
+                'creationTimestamp': KUBE_DATE,
+                'labels': {'client-id': f"client-{num % 40}", 'work-stream': 'core', 'service-class': 'gold'},
+            },
+            'status': {'phase': 'Active'},
+        }
+
+    def pod(self, num):
+        return {
+            'metadata': {
+                'name': f"pod-{num:05d}",
+                'namespace': f"ns-{num % self.namespaces:04d}",
+                'creationTimestamp': KUBE_DATE,
+            },
+            'spec': {'containers': [{'name': 'app', 'image': f"registry.example.com/app:{num % 20}"}]},
+            'status': {'phase': 'Running'},
+        }
+
+    def job(self, num):
+        failed = num % 2 == 0
+        condition = {'type': 'Failed' if failed else 'Complete', 'status': 'True', 'message': 'BackoffLimitExceeded'}
+        status = {'conditions': [condition], 'startTime': KUBE_DATE}
+
+        if failed:
+            status['failed'] = 1
+        else:
+            status['succeeded'] = 1
+            status['completionTime'] = KUBE_DATE
+
+        return {
+            'metadata': {'name': f"job-{num:05d}", 'namespace': f"ns-{num % self.namespaces:04d}", 'creationTimestamp': KUBE_DATE},
+            'status': status,
+        }
+
+
+# Existing branch restrictions of every repo: master is fully checked with a
+# duplicate and a drifted value, develop is not checked yet
+RESTRICTIONS = [
+    {'kind': 'require_approvals_to_merge', 'branch_match_kind': 'glob', 'pattern': 'master', 'value': 2},
+    {'kind': 'require_passing_builds_to_merge', 'branch_match_kind': 'glob', 'pattern': 'master', 'value': 1},
+    {'kind': 'require_tasks_to_be_completed', 'branch_match_kind': 'glob', 'pattern': 'master'},
+    {'kind': 'push', 'branch_match_kind': 'glob', 'pattern': 'master',
+     'groups': [{'name': 'Administrators', 'slug': 'Administrators'}], 'users': []},
+    {'kind': 'force', 'branch_match_kind': 'glob', 'pattern': 'master'},
+    {'kind': 'delete', 'branch_match_kind': 'glob', 'pattern': 'master'},
+    {'kind': 'delete', 'branch_match_kind': 'glob', 'pattern': 'master'},
+]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def dataset(self):
+        return self.server.dataset
+
+    def count(self, name):
+        with self.server.lock:
+            self.server.stats[name] = self.server.stats.get(name, 0) + 1
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_chunks(self, chunks):
+        """
+        Streams a large body with chunked encoding instead of building it in memory
+        """
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        buffer = []
+        size = 0
+
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+
+            if size > 65536:
+                self.write_chunk(b''.join(buffer))
+                buffer, size = [], 0
+
+        if buffer:
+            self.write_chunk(b''.join(buffer))
+
+        self.wfile.write(b'0\r\n\r\n')
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b'\r\n')
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def page(self, path, query, total, build):
+        """
+        A Bitbucket 2.0 paginated response
+
+        :param total: int, Number of items in the collection
+        :param build: callable, Builds the item with the given index
+        """
+
+        number = int(query.get('page', ['1'])[0])
+        pagelen = min(100, int(query.get('pagelen', ['10'])[0]))
+        start = (number - 1) * pagelen
+
+        data = {
+            'size': total,
+            'page': number,
+            'pagelen': pagelen,
+            'values': [build(num) for num in range(start, min(total, start + pagelen))],
+        }
+
+        if start + pagelen < total:
+            params = {key: values[0] for key, values in query.items()}
+            params['page'] = number + 1
+            data['next'] = f"http://{self.headers['Host']}{path}?{urlencode(params)}"
+
+        self.count('bitbucket_pages')
+        self.send_json(data)
+
+    def route(self, method):
+        time.sleep(self.server.latency)
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [part for part in url.path.split('/') if part]
+        dataset = self.dataset
+
+        # Bitbucket
+        if parts[:2] == ['2.0', 'repositories'] and len(parts) == 3:
+            return self.page(url.path, query, dataset.repos, lambda num: dataset.repo(parts[2], num))
+        if parts[:2] == ['2.0', 'repositories'] and parts[4:6] == ['refs', 'branches'] and method == 'DELETE':
+            self.count('bitbucket_branch_deletes')
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+        if parts[:2] == ['2.0', 'repositories'] and parts[4:] == ['refs', 'branches']:
+            return self.page(url.path, query, dataset.branches, dataset.branch)
+        if parts[:2] == ['2.0', 'repositories'] and parts[4:5] == ['branch-restrictions']:
+            self.read_body()
+            self.count(f"bitbucket_restriction_{method.lower()}s")
+
+            if method == 'GET':
+                return self.page(url.path, query, len(RESTRICTIONS), lambda num: dict(RESTRICTIONS[num], id=num + 1))
+            if method == 'DELETE':
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+
+            return self.send_json({'id': 100, 'type': 'branchrestriction'}, status=201 if method == 'POST' else 200)
+        if parts[:2] == ['2.0', 'repositories'] and len(parts) == 4:
+            return self.send_json(dataset.repo(parts[2], int(parts[3].split('-')[-1] or 0)))
+        if parts[:2] == ['2.0', 'workspaces'] and parts[3:] == ['permissions']:
+            return self.page(url.path, query, dataset.users, lambda num: dataset.workspace_permission(parts[2], num))
+        if parts[:2] == ['2.0', 'workspaces'] and parts[3:5] == ['permissions', 'repositories'] and len(parts) == 6:
+            first = int(parts[5].split('-')[-1]) * dataset.repo_users
+            return self.page(
+                url.path, query, dataset.repo_users, lambda num: dataset.repo_permission(parts[2], first + num)
+            )
+        if parts[:2] == ['2.0', 'workspaces'] and parts[3:] == ['permissions', 'repositories']:
+            total = dataset.repos * dataset.repo_users
+            return self.page(url.path, query, total, lambda num: dataset.repo_permission(parts[2], num))
+        if parts[:2] == ['1.0', 'group-privileges'] and method == 'GET':
+            self.count('bitbucket_group_privileges')
+            repos = [int(parts[3].split('-')[-1])] if len(parts) > 3 else range(dataset.repos)
+            return self.send_json([
+                {'repo': f"{parts[2]}/repo-{num:05d}", 'privilege': privilege, 'group': {'slug': group, 'name': group}}
+                for num in repos for group, privilege in (('pz-cloud-eng', 'write'), ('pz-cloud-sre', 'read'))
+                if num % 10 or group == 'pz-cloud-eng'
+            ])
+        if parts[:2] == ['1.0', 'group-privileges']:
+            self.read_body()
+            self.count('bitbucket_group_privileges')
+            return self.send_json([{'privilege': 'write'}])
+
+        # Artifactory
+        if parts[:4] == ['artifactory', 'api', 'search', 'aql'] and method == 'POST':
+            return self.aql(self.read_body().decode('utf-8'))
+        if parts[:3] == ['artifactory', 'api', 'storage'] and method == 'GET' and 'list' in url.query.split('&'):
+            self.count('artifactory_lists')
+            return self.listing(parts[3], '/'.join(parts[4:]).strip('/'))
+        if parts[:3] == ['artifactory', 'api', 'storage'] and method == 'GET':
+            repo, path = parts[3], '/'.join(parts[4:])
+            self.count('artifactory_stats')
+            return self.send_json({
+                'repo': repo, 'path': f"/{path}", 'created': ART_DATE, 'createdBy': 'ci',
+                'lastModified': ART_DATE, 'modifiedBy': 'ci', 'lastUpdated': ART_DATE,
+                'downloadUri': f"http://{self.headers['Host']}/artifactory/{repo}/{path}",
+                'mimeType': 'application/java-archive', 'size': '1024',
+                'checksums': {'sha1': '0' * 40, 'md5': '0' * 32, 'sha256': '0' * 64},
+                'originalChecksums': {'sha1': '0' * 40, 'md5': '0' * 32, 'sha256': '0' * 64},
+                'uri': f"http://{self.headers['Host']}/artifactory/api/storage/{repo}/{path}",
+            })
+        if parts[:1] == ['artifactory'] and method == 'DELETE':
+            self.count('artifactory_deletes')
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            return self.end_headers()
+
+        # Kubernetes
+        if parts == ['api', 'v1', 'namespaces']:
+            self.count('kubernetes_lists')
+            return self.send_json({
+                'kind': 'NamespaceList', 'apiVersion': 'v1', 'metadata': {},
+                'items': [dataset.namespace(num) for num in range(dataset.namespaces)],
+            })
+        if parts[:3] == ['api', 'v1', 'namespaces'] and parts[4:] == ['pods']:
+            index = int(parts[3].split('-')[-1])
+            self.count('kubernetes_lists')
+            return self.send_json({
+                'kind': 'PodList', 'apiVersion': 'v1', 'metadata': {},
+                'items': [dataset.pod(num) for num in range(index, dataset.pods, dataset.namespaces)],
+            })
+        if parts == ['api', 'v1', 'pods']:
+            self.count('kubernetes_lists')
+            return self.send_json({
+                'kind': 'PodList', 'apiVersion': 'v1', 'metadata': {},
+                'items': [dataset.pod(num) for num in range(dataset.pods)],
+            })
+        if parts == ['apis', 'batch', 'v1', 'jobs']:
+            self.count('kubernetes_lists')
+            return self.send_json({
+                'kind': 'JobList', 'apiVersion': 'batch/v1', 'metadata': {},
+                'items': [dataset.job(num) for num in range(dataset.jobs)],
+            })
+        if parts[:4] == ['apis', 'batch', 'v1', 'namespaces'] and method == 'DELETE':
+            self.read_body()
+            self.count('kubernetes_deletes')
+            return self.send_json({'kind': 'Status', 'apiVersion': 'v1', 'metadata': {}, 'status': 'Success'})
+
+        self.send_json({'error': f"No fake for {method} {url.path}"}, status=404)
+
+    def aql(self, text):
+        """
+        Answers an AQL items.find() with synthetic artifacts, honouring
+        .offset() and .limit() so paged searches can be benchmarked
+        """
+
+        repo = re.search(r'"repo":\s*(?:\{"\$match":\s*)?"([^"]+)"', text)
+        repo = repo.group(1) if repo else 'libs-release'
+        docker = 'manifest.json' in text or 'docker' in repo
+        offset = int((re.search(r'\.offset\((\d+)\)', text) or [0, 0])[1])
+        limit = re.search(r'\.limit\((\d+)\)', text)
+        end = min(self.dataset.artifacts, offset + int(limit.group(1))) if limit else self.dataset.artifacts
+
+        def chunks():
+            yield b'{"results":['
+
+            for num in range(offset, end):
+                yield (b',' if num > offset else b'') + json.dumps(self.dataset.artifact(repo, num, docker)).encode('utf-8')
+
+            summary = {'start_pos': offset, 'end_pos': end, 'total': max(0, end - offset)}
+            yield b'],"range":' + json.dumps(summary).encode('utf-8') + b'}'
+
+        self.count('artifactory_searches')
+        self.send_chunks(chunks())
+
+    def listing(self, repo, path):
+        """
+        Answers a deep storage listing of a folder, streaming the files below
+        it with their uri relative to the folder
+        """
+
+        dataset = self.dataset
+        docker = 'docker' in repo
+        prefix = f"{path}/" if path else ''
+
+        def chunks():
+            uri = f"http://{self.headers['Host']}/artifactory/api/storage/{repo}/{path}".rstrip('/')
+            yield f'{{"uri":"{uri}","created":"{ART_DATE}","files":['.encode('utf-8')
+            first = True
+
+            for num in range(dataset.artifacts):
+                item = dataset.artifact(repo, num, docker)
+                file_path = f"{item['path']}/{item['name']}"
+
+                if not file_path.startswith(prefix):
+                    continue
+
+                entry = {
+                    'uri': f"/{file_path[len(prefix):]}", 'size': item['size'], 'lastModified': ART_DATE,
+                    'folder': False, 'sha1': '0' * 40,
+                }
+                yield (b'' if first else b',') + json.dumps(entry).encode('utf-8')
+                first = False
+
+            yield b']}'
+
+        self.send_chunks(chunks())
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset=None, latency=0.0, address=('127.0.0.1', 0)):
+        super(FakeServer, self).__init__(address, Handler)
+        self.dataset = dataset or Dataset()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    @property
+    def url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def reset_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            self.stats.clear()
+
+        return stats
@@ -0,0 +1,120 @@
+"""
+Cold start benchmark for the gadget cli
+
+Profiles the lazy root namespace and every task module in fresh interpreters,
+reports the median of several rounds and optionally gates against a saved
+baseline:
+
+    python benchmarks/startup.py --rounds 5 --output startup.json
+    python benchmarks/startup.py --baseline startup.json --threshold 1.25
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gadget import startup  # noqa: E402
+
+METRICS = ('seconds', 'maxrss_delta_kb', 'modules_loaded')
+
+
+def summarize(rounds):
+    """
+    :param rounds: list, Startup reports from `startup.profile_startup`
+    :return dict: Median of every metric keyed on module
+    """
+
+    samples = {}
+
+    for report in rounds:
+        for item in [report['namespace']] + report['modules']:
+            samples.setdefault(item['module'], []).append(item)
+
+    summary = {}
+
+    for name, items in samples.items():
+        summary[name] = {
+            metric: statistics.median([item.get(metric) or 0 for item in items]) for metric in METRICS
+        }
+        summary[name]['error'] = items[-1].get('error')
+        summary[name]['stdout'] = bool(items[-1].get('stdout'))
+        summary[name]['locale_changed'] = items[-1].get('locale_changed', False)
+
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    """
+    :param summary: dict, The current summary
+    :param baseline: dict, A summary saved by a previous run
+    :param threshold: float, Allowed ratio of current to baseline import time
+    :return list: Descriptions of every regression found
+    """
+
+    regressions = []
+
+    for name, current in summary.items():
+        previous = baseline.get(name)
+
+        if previous is None:
+            continue
+
+        if previous['seconds'] and current['seconds'] > previous['seconds'] * threshold:
+            regressions.append(
+                f"{name}: {current['seconds']:.3f}s vs baseline {previous['seconds']:.3f}s"
+            )
+
+        for flag in ('stdout', 'locale_changed'):
+            if current[flag] and not previous[flag]:
+                regressions.append(f"{name}: new import side effect ({flag})")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--module', action='append', dest='modules', help="Limit to a task module, repeatable")
+    parser.add_argument('--python', help="Interpreter to profile, defaults to the current one")
+    parser.add_argument('--output', help="Write the json summary to this file")
+    parser.add_argument('--baseline', help="A json summary to compare against")
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args()
+
+    rounds = [startup.profile_startup(modules=args.modules, python=args.python) for _ in range(args.rounds)]
+    summary = summarize(rounds)
+
+    for name, item in sorted(summary.items(), key=lambda i: i[1]['seconds'], reverse=True):
+        flags = [flag for flag in ('stdout', 'locale_changed') if item[flag]]
+        if item['error']:
+            flags.append(f"error={item['error']}")
+
+        print(f"{name:<14}{item['seconds'] * 1000:>10.1f} ms{item['maxrss_delta_kb']:>10.0f} KB"
+              f"{item['modules_loaded']:>7.0f} mods  {' '.join(flags)}")
+
+    document = json.dumps({'rounds': args.rounds, 'python': rounds[0]['python'], 'modules': summary}, indent=2)
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            fh.write(document)
+    else:
+        print(document)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as fh:
+            baseline = json.load(fh)['modules']
+
+        regressions = compare(summary, baseline, args.threshold)
+
+        for item in regressions:
+            print(f"REGRESSION {item}", file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
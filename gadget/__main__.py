@@ -1,3 +1,3 @@
-from gadget.main import program
+from gadget.client import main
 
-program.run()
+main()
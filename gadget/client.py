@@ -0,0 +1,57 @@
+import json
+import os
+import socket
+import sys
+
+#
+# Thin gadget client. When GADGET_SOCKET points at a running `gadget serve`
+# the command line is forwarded to it, otherwise gadget runs in-process. Only
+# the standard library is imported before that decision is made.
+#
+
+
+def socket_path():
+    """
+    :return string: The unix socket of the gadget server
+    """
+
+    cache_home = os.environ.get('GADGET_CACHE_DIR', os.path.expanduser('~/.cache/gadget'))
+    return os.environ.get('GADGET_SOCKET') or os.path.join(cache_home, 'gadget.sock')
+
+
+def forward(path, argv):
+    """
+    :param path: string, The server socket
+    :param argv: list, The gadget arguments, without the binary name
+    :return int: The exit code of the command
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall((json.dumps({'argv': argv, 'cwd': os.getcwd()}) + '\n').encode('utf-8'))
+
+        for line in sock.makefile('r', encoding='utf-8'):
+            frame = json.loads(line)
+
+            if 'exit' in frame:
+                return frame['exit']
+
+            stream = sys.stderr if frame.get('stream') == 'stderr' else sys.stdout
+            stream.write(frame['data'])
+            stream.flush()
+
+    # The server went away before the command finished
+    return 1
+
+
+def main():
+    argv = sys.argv[1:]
+
+    if os.environ.get('GADGET_SOCKET') and argv[:1] != ['serve']:
+        try:
+            sys.exit(forward(os.environ['GADGET_SOCKET'], argv))
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+
+    from gadget.main import program
+    program.run()
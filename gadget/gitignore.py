@@ -0,0 +1,181 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from pathlib import Path
+
+#
+# Local cache of the gitignore.io templates used when bootstrapping repos.
+# Template bodies are stored by their sha256 and an index maps each template
+# name to its current body and fetch time. Templates older than the ttl are
+# served from the cache and refreshed in the background, gitignore.io is only
+# waited on when a template was never cached, and when it can't be reached
+# the seed bundled in gadget/templates/gitignore is used instead.
+#
+settings = {
+    'url': 'https://gitignore.io/api',
+    'ttl': 7 * 24 * 3600,
+    'timeout': 3,
+}
+
+SEED_DIR = Path(__file__).parent.joinpath('templates', 'gitignore')
+
+_lock = threading.Lock()
+_index_lock = threading.Lock()
+_locks = {}
+_loaded = {}
+
+
+def configure(url=None, ttl=None, timeout=None):
+    """
+    Updates the template cache settings, usually from the `gitignore` section of gadget.yaml
+    """
+
+    overrides = dict(url=url, ttl=ttl, timeout=timeout)
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+
+
+def root():
+    from gadget.tasks import utils
+
+    return utils.cache_dir('gitignore')
+
+
+def read_index():
+    try:
+        with open(root().joinpath('index.json'), 'r') as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+
+    with os.fdopen(fd, 'wb') as fh:
+        fh.write(data)
+
+    os.replace(tmp, path)
+
+
+def read_object(digest):
+    """
+    :param digest: string, The sha256 of the template body
+    :return bytes: The template body, None when missing or corrupt
+    """
+
+    try:
+        data = root().joinpath('objects', digest).read_bytes()
+    except OSError:
+        return None
+
+    return data if hashlib.sha256(data).hexdigest() == digest else None
+
+
+def store(name, data):
+    """
+    Stores a template body and points the index entry of the template at it
+
+    :param name: string, The template name (eg: java)
+    :param data: bytes, The template body
+    """
+
+    digest = hashlib.sha256(data).hexdigest()
+    objects = root().joinpath('objects')
+    objects.mkdir(exist_ok=True)
+
+    if not objects.joinpath(digest).exists():
+        write_atomic(objects.joinpath(digest).as_posix(), data)
+
+    # Background refreshes of other templates update the index too
+    with _index_lock:
+        index = read_index()
+        index[name] = {'sha256': digest, 'fetched': time.time()}
+        write_atomic(root().joinpath('index.json').as_posix(), json.dumps(index, indent=2).encode('utf-8'))
+
+
+def seed(name):
+    """
+    :param name: string, The template name
+    :return bytes: The bundled template, None when there is none
+    """
+
+    try:
+        return SEED_DIR.joinpath(f"{name}.gitignore").read_bytes()
+    except OSError:
+        return None
+
+
+def fetch(name):
+    """
+    Reads a template from gitignore.io in a single attempt, without the
+    retries and rate limiting of the shared transport
+
+    :param name: string, The template name
+    :return bytes: The template from gitignore.io
+    """
+
+    import requests
+
+    response = requests.get(f"{settings['url']}/{name}", timeout=settings['timeout'])
+    response.raise_for_status()
+    return response.content
+
+
+def refresh(name):
+    """
+    Replaces an expired template in the cache, failures keep the cached copy
+
+    :param name: string, The template name
+    """
+
+    try:
+        store(name, fetch(name))
+        logging.debug(f"Refreshed the {name} gitignore template")
+    except Exception as e:
+        logging.debug(f"Unable to refresh the {name} gitignore template: {e}")
+
+
+def template(name):
+    """
+    :param name: string, The template name (eg: java, node)
+    :return bytes: The template, empty when none is available
+    """
+
+    if not name:
+        return b''
+
+    with _lock:
+        lock = _locks.setdefault(name, threading.Lock())
+
+    # One fetch per template and process, however many repos are bootstrapped
+    with lock:
+        if name in _loaded:
+            return _loaded[name]
+
+        entry = read_index().get(name)
+        cached = read_object(entry['sha256']) if entry else None
+
+        if cached is not None:
+            data = cached
+
+            if time.time() - entry['fetched'] >= settings['ttl']:
+                threading.Thread(target=refresh, args=(name,), name=f"gitignore-{name}", daemon=True).start()
+        else:
+            try:
+                data = fetch(name)
+                store(name, data)
+                logging.debug(f"Fetched the {name} gitignore template")
+            except Exception as e:
+                data = seed(name)
+                logging.warning(
+                    f"Unable to fetch the {name} gitignore template ({e}), "
+                    f"using the {'bundled' if data is not None else 'empty'} template"
+                )
+
+        _loaded[name] = data or b''
+        return _loaded[name]
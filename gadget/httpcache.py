@@ -0,0 +1,223 @@
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+#
+# On-disk cache for read-only GET requests. Listing tasks opt in with
+# `with httpcache.policy():`, responses younger than the ttl are served from
+# disk and older ones are revalidated with If-None-Match/If-Modified-Since.
+# Entries are evicted least recently used first once max_size is exceeded.
+#
+settings = {
+    'enabled': os.environ.get('GADGET_NO_CACHE', '0') == '0',
+    'ttl': 300,
+    'max_size': 256 * 1024 * 1024,
+}
+
+# Set from the --no-cache flag on every gadget run
+disabled = False
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS response (
+        key TEXT PRIMARY KEY,
+        url TEXT,
+        etag TEXT,
+        last_modified TEXT,
+        headers TEXT,
+        body BLOB,
+        size INTEGER,
+        stored REAL,
+        accessed REAL
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS response_accessed ON response (accessed);",
+]
+
+# Headers that don't identify the caller and are left out of the cache key
+IGNORED_HEADERS = {'user-agent', 'accept-encoding', 'connection', 'if-none-match', 'if-modified-since'}
+
+# Headers that describe the transfer rather than the stored (decoded) body
+DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection', 'set-cookie'}
+
+_policy = contextvars.ContextVar('gadget_http_cache', default=None)
+_lock = threading.Lock()
+_db = None
+
+
+def configure(enabled=None, ttl=None, max_size=None):
+    """
+    Updates the cache settings, usually from the `http_cache` section of gadget.yaml
+    """
+
+    overrides = dict(enabled=enabled, ttl=ttl, max_size=max_size)
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+
+
+@contextmanager
+def policy(ttl=None):
+    """
+    Caches the GET requests made in this block, including requests the block
+    hands to the shared scheduler
+
+    :param ttl: int, Seconds a response is served without revalidation
+    """
+
+    if disabled or not settings['enabled']:
+        yield
+        return
+
+    token = _policy.set(settings['ttl'] if ttl is None else ttl)
+
+    try:
+        yield
+    finally:
+        _policy.reset(token)
+
+
+def active():
+    """
+    :return int: The ttl of the current cache policy, None when not caching
+    """
+
+    return None if disabled else _policy.get()
+
+
+def db():
+    global _db
+
+    # Imported on first use, `gadget --version` and `gadget -l` never open the cache
+    import sqlite3
+
+    with _lock:
+        if _db is None:
+            from gadget.tasks import utils
+
+            _db = sqlite3.connect(
+                utils.cache_dir('http').joinpath('cache.db').as_posix(),
+                check_same_thread=False,
+                isolation_level=None,
+            )
+            _db.execute("PRAGMA journal_mode=WAL")
+
+            for statement in SCHEMA:
+                _db.execute(statement)
+
+        return _db
+
+
+def cache_key(request):
+    identity = sorted(
+        (name.lower(), value) for name, value in request.headers.items() if name.lower() not in IGNORED_HEADERS
+    )
+    raw = json.dumps([request.method, request.url, identity])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def cached_response(request, headers, body):
+    import requests
+    from requests.structures import CaseInsensitiveDict
+    from requests.utils import get_encoding_from_headers
+
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = 'OK'
+    response.url = request.url
+    response.request = request
+    response.headers = CaseInsensitiveDict(json.loads(headers))
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = body
+    response._content_consumed = True
+    response.from_cache = True
+    return response
+
+
+def evict(conn):
+    with _lock:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+
+        while total > settings['max_size']:
+            rows = conn.execute("SELECT key, size FROM response ORDER BY accessed LIMIT 50").fetchall()
+
+            if not rows:
+                break
+
+            conn.executemany("DELETE FROM response WHERE key = ?", [(key,) for key, _ in rows])
+            total -= sum(size for _, size in rows)
+            logging.debug(f"Evicted {len(rows)} cached responses")
+
+
+def fetch(request, ttl, send):
+    """
+    :param request: PreparedRequest, A GET request
+    :param ttl: int, Freshness lifetime in seconds
+    :param send: callable, Sends the request over the network
+    :return Response: A response from the cache or the network
+    """
+
+    import sqlite3
+
+    key = cache_key(request)
+    now = time.time()
+
+    try:
+        conn = db()
+
+        with _lock:
+            entry = conn.execute(
+                "SELECT etag, last_modified, headers, body, stored FROM response WHERE key = ?", (key,)
+            ).fetchone()
+    except (OSError, sqlite3.Error) as e:
+        logging.debug(f"HTTP cache unavailable: {e}")
+        return send()
+
+    if entry is not None:
+        etag, last_modified, headers, body, stored = entry
+
+        if now - stored < ttl:
+            with _lock:
+                conn.execute("UPDATE response SET accessed = ? WHERE key = ?", (now, key))
+            return cached_response(request, headers, body)
+
+        if etag:
+            request.headers['If-None-Match'] = etag
+        if last_modified:
+            request.headers['If-Modified-Since'] = last_modified
+
+    response = send()
+
+    if response.status_code == 304 and entry is not None:
+        response.close()
+
+        with _lock:
+            conn.execute("UPDATE response SET stored = ?, accessed = ? WHERE key = ?", (now, now, key))
+        return cached_response(request, headers, body)
+
+    if response.status_code == 200:
+        content = response.content
+        stored_headers = {
+            name: value for name, value in response.headers.items() if name.lower() not in DROPPED_HEADERS
+        }
+
+        try:
+            with _lock:
+                conn.execute(
+                    "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key, request.url,
+                        response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                        json.dumps(stored_headers), content, len(content), now, now,
+                    )
+                )
+
+            evict(conn)
+        except sqlite3.Error as e:
+            logging.debug(f"Unable to cache {request.url}: {e}")
+
+    return response
@@ -1,6 +1,7 @@
+import json
 
-from invoke import Program, Argument, Collection
-from gadget import tasks
+from invoke import Program, Argument, Collection, Exit
+from gadget import httpcache, metrics, tasks
 from gadget import __version__ as gadget_version
 
 
@@ -14,14 +15,65 @@ class Gadget(Program):
             Argument(
                 names=('filter', 'fl'), help="Apply a filter to a list of resources in a project"
             ),
+            Argument(
+                names=('profile-startup',), kind=bool, default=False,
+                help="Print a json report of the cold start cost of gadget and each task module"
+            ),
+            Argument(
+                names=('no-cache',), kind=bool, default=False,
+                help="Bypass the HTTP response cache used by listing tasks"
+            ),
+            Argument(
+                names=('metrics',),
+                help="Write run metrics to a file, as a Prometheus textfile if it ends with .prom (- for stdout)"
+            ),
         ]
         return core_args + extra_args
 
+    def parse_core(self, argv):
+        super(Gadget, self).parse_core(argv)
+        httpcache.disabled = self.args['no-cache'].value
+        metrics.reset()
+
+        if self.args['profile-startup'].value:
+            from gadget import startup
+
+            print(json.dumps(startup.profile_startup(), indent=2))
+            raise Exit
+
+    def requested_collections(self):
+        """
+        :return set: The task collections referenced on the command line
+        """
+
+        words = [item for item in self.core.unparsed if not item.startswith('-')]
+
+        if isinstance(self.args.help.value, str):
+            words.append(self.args.help.value)
+
+        return {word.split('.')[0] for word in words if word.split('.')[0] in tasks.COLLECTIONS}
+
+    def parse_collection(self):
+        # Only import the task modules that are about to be invoked
+        self.namespace = tasks.load_namespace(self.requested_collections())
+        super(Gadget, self).parse_collection()
+
+    def execute(self):
+        try:
+            super(Gadget, self).execute()
+        finally:
+            if self.args.metrics.value:
+                metrics.write(self.args.metrics.value)
+
+
+def make_program():
+    return Gadget(
+        name="Gadget",
+        binary="gadget",
+        binary_names=["gadget"],
+        version=gadget_version.__version__,
+        namespace=Collection()
+    )
+
 
-program = Gadget(
-    name="Gadget",
-    binary="gadget",
-    binary_names=["gadget"],
-    version=gadget_version.__version__,
-    namespace=Collection.from_module(tasks)
-)
+program = make_program()
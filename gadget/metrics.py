@@ -0,0 +1,270 @@
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from urllib.parse import urlparse
+
+#
+# Run metrics. Every task records its wall time, every HTTP request made
+# through gadget.transport records its latency, size and retries against the
+# service it was sent to, and tasks count the items they processed with
+# `metrics.count()`. The totals are written at the end of a run with
+# `gadget --metrics <file>`, as json or as a Prometheus textfile (.prom).
+#
+
+# Service names keyed on host name suffix, other hosts are reported as is
+SERVICES = {
+    'api.bitbucket.org': 'bitbucket',
+    'bitbucket.org': 'bitbucket',
+    'jfrog.io': 'artifactory',
+    'digicert.com': 'digicert',
+    'graph.microsoft.com': 'azure',
+    'atlassian.net': 'atlassian',
+    'app.terraform.io': 'terraform',
+    'gitignore.io': 'gitignore',
+}
+
+# Latency histogram bucket bounds in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_current = contextvars.ContextVar('gadget_task', default=None)
+_lock = threading.Lock()
+_tasks = {}
+_http = {}
+_items = {}
+_started = time.time()
+
+
+def reset():
+    global _started
+
+    with _lock:
+        _tasks.clear()
+        _http.clear()
+        _items.clear()
+        _started = time.time()
+
+
+def service(url):
+    """
+    :param url: string, The request url
+    :return string: The service name for the url host
+    """
+
+    host = urlparse(str(url)).hostname or 'unknown'
+
+    return next(
+        (name for suffix, name in SERVICES.items() if host == suffix or host.endswith(f".{suffix}")),
+        host
+    )
+
+
+def timed(name, body):
+    """
+    Wraps a task body so every call records its wall time under `name`
+
+    :param name: string, The task name (eg: bitbucket.list-repos)
+    :param body: callable, The task body
+    :return callable: The wrapped body
+    """
+
+    if getattr(body, 'timed', False):
+        return body
+
+    @functools.wraps(body)
+    def wrapper(*args, **kwargs):
+        token = _current.set(name)
+        start = time.perf_counter()
+        failed = True
+
+        try:
+            result = body(*args, **kwargs)
+            failed = False
+            return result
+        except SystemExit as e:
+            failed = bool(e.code)
+            raise
+        finally:
+            _current.reset(token)
+            record_task(name, time.perf_counter() - start, failed)
+
+    # invoke reads the task arguments from the body signature
+    wrapper.__signature__ = inspect.signature(body)
+    wrapper.timed = True
+    return wrapper
+
+
+def instrument(collection):
+    """
+    Times every task of a collection
+
+    :param collection: Collection, An invoke collection
+    :return Collection: The same collection
+    """
+
+    for name, t in collection.tasks.items():
+        t.body = timed(f"{collection.name}.{name}" if collection.name else name, t.body)
+
+    return collection
+
+
+def record_task(name, seconds, failed=False):
+    with _lock:
+        entry = _tasks.setdefault(name, {'runs': 0, 'failures': 0, 'seconds': 0.0})
+        entry['runs'] += 1
+        entry['failures'] += int(failed)
+        entry['seconds'] += seconds
+
+
+def record_request(url, seconds, status=None, sent=0, received=0, retries=0):
+    """
+    :param url: string, The request url
+    :param seconds: float, Time until the response headers arrived, including retries
+    :param status: int, The final response status, None when the request failed
+    :param sent: int, Request body bytes
+    :param received: int, Response body bytes
+    :param retries: int, Times the request was retried
+    """
+
+    name = service(url)
+
+    with _lock:
+        entry = _http.setdefault(name, {
+            'calls': 0, 'errors': 0, 'retries': 0, 'bytes_sent': 0, 'bytes_received': 0,
+            'seconds': 0.0, 'buckets': [0] * len(BUCKETS), 'statuses': {},
+        })
+        entry['calls'] += 1
+        entry['errors'] += int(status is None or status >= 400)
+        entry['retries'] += retries
+        entry['bytes_sent'] += sent
+        entry['bytes_received'] += received
+        entry['seconds'] += seconds
+
+        for num, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry['buckets'][num] += 1
+
+        key = str(status or 'error')
+        entry['statuses'][key] = entry['statuses'].get(key, 0) + 1
+
+
+def count(name, value=1):
+    """
+    Counts items processed by the running task (eg: artifacts_deleted)
+
+    :param name: string, The counter name
+    :param value: int, The amount to add
+    """
+
+    key = (_current.get() or 'gadget', name)
+
+    with _lock:
+        _items[key] = _items.get(key, 0) + value
+
+
+def snapshot():
+    """
+    :return dict: The metrics recorded so far
+    """
+
+    with _lock:
+        items = {}
+
+        for (task_name, name), value in _items.items():
+            items.setdefault(task_name, {})[name] = value
+
+        return {
+            'started': _started,
+            'seconds': time.time() - _started,
+            'tasks': {name: dict(entry) for name, entry in _tasks.items()},
+            'http': {
+                name: dict(entry, buckets=dict(zip(map(str, BUCKETS), entry['buckets'])), statuses=dict(entry['statuses']))
+                for name, entry in _http.items()
+            },
+            'items': items,
+        }
+
+
+def prometheus(data):
+    """
+    :param data: dict, A metrics snapshot
+    :return string: The snapshot in the Prometheus text format
+    """
+
+    lines = [
+        "# TYPE gadget_run_seconds gauge",
+        f"gadget_run_seconds {data['seconds']:.6f}",
+        "# TYPE gadget_task_seconds gauge",
+        "# TYPE gadget_task_runs_total counter",
+        "# TYPE gadget_task_failures_total counter",
+    ]
+
+    for name, entry in sorted(data['tasks'].items()):
+        lines.append(f'gadget_task_seconds{{task="{name}"}} {entry["seconds"]:.6f}')
+        lines.append(f'gadget_task_runs_total{{task="{name}"}} {entry["runs"]}')
+        lines.append(f'gadget_task_failures_total{{task="{name}"}} {entry["failures"]}')
+
+    lines.append("# TYPE gadget_http_requests_total counter")
+    lines.append("# TYPE gadget_http_retries_total counter")
+    lines.append("# TYPE gadget_http_sent_bytes_total counter")
+    lines.append("# TYPE gadget_http_received_bytes_total counter")
+    lines.append("# TYPE gadget_http_request_seconds histogram")
+
+    for name, entry in sorted(data['http'].items()):
+        label = f'service="{name}"'
+
+        for status, value in sorted(entry['statuses'].items()):
+            lines.append(f'gadget_http_requests_total{{{label},status="{status}"}} {value}')
+
+        lines.append(f'gadget_http_retries_total{{{label}}} {entry["retries"]}')
+        lines.append(f'gadget_http_sent_bytes_total{{{label}}} {entry["bytes_sent"]}')
+        lines.append(f'gadget_http_received_bytes_total{{{label}}} {entry["bytes_received"]}')
+
+        for bound, value in entry['buckets'].items():
+            lines.append(f'gadget_http_request_seconds_bucket{{{label},le="{bound}"}} {value}')
+
+        lines.append(f'gadget_http_request_seconds_bucket{{{label},le="+Inf"}} {entry["calls"]}')
+        lines.append(f'gadget_http_request_seconds_sum{{{label}}} {entry["seconds"]:.6f}')
+        lines.append(f'gadget_http_request_seconds_count{{{label}}} {entry["calls"]}')
+
+    lines.append("# TYPE gadget_items_total counter")
+
+    for task_name, counters in sorted(data['items'].items()):
+        for name, value in sorted(counters.items()):
+            lines.append(f'gadget_items_total{{task="{task_name}",item="{name}"}} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write(path):
+    """
+    Writes the metrics as json, or as a Prometheus textfile when the path ends
+    with .prom. The file is replaced atomically so collectors never read a
+    partial file, `-` prints json to stdout.
+
+    :param path: string, The output location
+    """
+
+    data = snapshot()
+
+    if path == '-':
+        print(json.dumps(data, indent=2))
+        return
+
+    text = prometheus(data) if path.endswith('.prom') else json.dumps(data, indent=2)
+    directory = os.path.dirname(os.path.abspath(path))
+
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(text)
+
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, path)
+    logging.debug(f"Wrote metrics to {path}")
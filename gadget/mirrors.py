@@ -0,0 +1,201 @@
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+
+#
+# Local bare mirrors of the repositories git based tasks work on, kept in
+# ~/.cache/gadget/mirrors/<workspace>/<repo>.git. The first use clones the
+# mirror, later uses only fetch what changed. Tasks get a throwaway checkout
+# that borrows its objects from the mirror, and the least recently used
+# mirrors are removed once the cache grows past max_size.
+#
+settings = {
+    'enabled': os.environ.get('GADGET_NO_MIRRORS', '0') == '0',
+    'max_size': 5 * 1024 * 1024 * 1024,
+}
+
+# Touched on every use, its mtime orders the mirrors for eviction
+STAMP = 'gadget-used'
+
+_lock = threading.Lock()
+_locks = {}
+
+
+def configure(enabled=None, max_size=None):
+    """
+    Updates the mirror settings, usually from the `mirrors` section of gadget.yaml
+    """
+
+    overrides = dict(enabled=enabled, max_size=max_size)
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+
+
+def root():
+    from gadget.tasks import utils
+
+    return utils.cache_dir('mirrors')
+
+
+def git(*args, cwd=None):
+    """
+    :param args: The git arguments
+    :param cwd: string, Directory to run git in
+    :return string: The git output
+    """
+
+    logging.debug(f"git {' '.join(args)}")
+    process = subprocess.run(['git', *args], cwd=cwd, capture_output=True, text=True)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"git {args[0]} failed: {process.stderr.strip()}")
+
+    return process.stdout
+
+
+@contextmanager
+def locked(path):
+    """
+    Serializes the use of a mirror between threads and gadget processes
+    """
+
+    with _lock:
+        thread_lock = _locks.setdefault(path, threading.Lock())
+
+    with thread_lock, open(f"{path}.lock", 'w') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def mirror_path(workspace, repo):
+    """
+    :return string: Location of the mirror of workspace/repo
+    """
+
+    path = root().joinpath(workspace)
+    path.mkdir(parents=True, exist_ok=True)
+    return path.joinpath(f"{repo}.git").as_posix()
+
+
+def update(clone_url, path):
+    """
+    Clones the mirror when missing, otherwise fetches the changes since the last use
+
+    :param clone_url: string, The repository clone url
+    :param path: string, The mirror location
+    """
+
+    start = time.perf_counter()
+
+    if os.path.isdir(path):
+        git('remote', 'set-url', 'origin', clone_url, cwd=path)
+        git('fetch', '--prune', '--quiet', 'origin', cwd=path)
+        action = 'Updated'
+    else:
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.clone-')
+
+        try:
+            git('clone', '--mirror', '--quiet', clone_url, tmp)
+            os.replace(tmp, path)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        action = 'Created'
+
+    open(os.path.join(path, STAMP), 'w').close()
+    logging.info(f"{action} mirror {path} in {time.perf_counter() - start:.1f}s")
+
+
+def size(path):
+    """
+    :return int: Bytes used by the files below path
+    """
+
+    total = 0
+
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+def last_used(path):
+    try:
+        return os.stat(os.path.join(path, STAMP)).st_mtime
+    except OSError:
+        return 0.0
+
+
+def evict(keep=None):
+    """
+    Removes the least recently used mirrors until the cache fits in max_size
+
+    :param keep: string, A mirror that is never removed (eg: the one in use)
+    """
+
+    mirrors = [
+        entry.path
+        for workspace in os.scandir(root()) if workspace.is_dir()
+        for entry in os.scandir(workspace.path) if entry.is_dir() and entry.name.endswith('.git')
+    ]
+    sizes = {path: size(path) for path in mirrors}
+    total = sum(sizes.values())
+
+    for path in sorted(mirrors, key=last_used):
+        if total <= settings['max_size']:
+            break
+        if path == keep:
+            continue
+
+        with locked(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+        total -= sizes[path]
+        logging.info(f"Evicted mirror {path} ({sizes[path] / 1024 / 1024:.1f} MB)")
+
+
+@contextmanager
+def checkout(clone_url, workspace, repo):
+    """
+    Yields a temporary checkout of a repository. Its objects are borrowed from
+    the local mirror, so only the changes since the last use are downloaded.
+    The checkout pushes to the real remote.
+
+    :param clone_url: string, The repository clone url
+    :param workspace: string, The workspace name
+    :param repo: string, The repository slug
+    :return string: The checkout location
+    """
+
+    with tempfile.TemporaryDirectory(prefix='gadget-') as tmpdirname:
+        if not settings['enabled']:
+            git('clone', '--quiet', clone_url, tmpdirname)
+            yield tmpdirname
+            return
+
+        path = mirror_path(workspace, repo)
+
+        with locked(path):
+            update(clone_url, path)
+            git('clone', '--shared', '--quiet', path, tmpdirname)
+            git('remote', 'set-url', 'origin', clone_url, cwd=tmpdirname)
+
+            # The mirror can't be pruned or evicted while the checkout uses its objects
+            yield tmpdirname
+
+        evict(keep=path)
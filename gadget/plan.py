@@ -0,0 +1,196 @@
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from invoke import task, Exit
+from rich.console import Console
+from rich.table import Table
+
+console = Console()
+
+
+def expand(steps):
+    """
+    Expands `foreach` steps into one step per item. Strings in the step name,
+    args and needs may reference the item as {item}.
+
+    :param steps: list, The plan steps
+    :return list: The expanded steps, every step has a unique name
+    """
+
+    def render(value, item):
+        if isinstance(value, str):
+            return value.replace('{item}', str(item))
+        if isinstance(value, list):
+            return [render(v, item) for v in value]
+        if isinstance(value, dict):
+            return {k: render(v, item) for k, v in value.items()}
+        return value
+
+    results = []
+
+    for num, step in enumerate(steps):
+        step = dict(step)
+        step.setdefault('name', f"{step['task']}-{num}")
+
+        for item in step.pop('foreach', [None]):
+            expanded = render(step, item) if item is not None else dict(step)
+
+            if item is not None and '{item}' not in step['name']:
+                expanded['name'] = f"{step['name']}-{item}"
+
+            results.append(expanded)
+
+    names = [step['name'] for step in results]
+    duplicates = {name for name in names if names.count(name) > 1}
+
+    if duplicates:
+        raise ValueError(f"Duplicate step names in plan: {sorted(duplicates)}")
+
+    for step in results:
+        unknown = [name for name in step.get('needs', []) if name not in names]
+
+        if unknown:
+            raise ValueError(f"Step {step['name']} needs unknown steps: {unknown}")
+
+    return results
+
+
+def prepare(ctx, t, done):
+    """
+    Runs the pre tasks of a task once for the whole plan
+
+    :param ctx: Context, The shared context
+    :param t: Task, The task about to run
+    :param done: set, Pre tasks already run
+    """
+
+    for pre in t.pre:
+        pre_task = getattr(pre, 'task', pre)
+
+        if pre_task in done:
+            continue
+
+        prepare(ctx, pre_task, done)
+        pre_task(ctx, *getattr(pre, 'args', ()), **getattr(pre, 'kwargs', {}))
+        done.add(pre_task)
+
+
+def run_step(ctx, t, step):
+    """
+    :return tuple: (status, seconds, error)
+    """
+
+    args = {key.replace('-', '_'): value for key, value in (step.get('args') or {}).items()}
+    start = time.perf_counter()
+
+    try:
+        t(ctx, **args)
+        return 'ok', time.perf_counter() - start, None
+    except SystemExit as e:
+        if not e.code:
+            return 'ok', time.perf_counter() - start, None
+        return 'failed', time.perf_counter() - start, f"exit {e.code}"
+    except Exception as e:
+        logging.error(f"Step {step['name']} failed: {e}")
+        return 'failed', time.perf_counter() - start, str(e)
+
+
+@task
+def run_plan(ctx, plan, config=None, concurrency=None):
+    """ Run a yaml plan of gadget tasks in one process
+    Parameter
+    ================
+    plan: Location of the plan file
+    config: Location of the gadget config, overrides the plan `config` key
+    concurrency: Max steps to run at once, overrides the plan `concurrency` key
+
+    Plan format:
+
+        config: gadget.yaml
+        concurrency: 4
+        steps:
+          - name: repo-{item}
+            task: bitbucket.add-repo
+            foreach: [api, web]
+            args: {repo: "workspace/{item}", project: PZ, profile: cloud}
+          - name: checks-{item}
+            task: bitbucket.add-branch-checks
+            foreach: [api, web]
+            args: {repo: "workspace/{item}"}
+            needs: [repo-{item}]
+
+    Steps without a dependency between them run concurrently, sharing the
+    loaded config and the clients in ctx.run_state. Steps that change the
+    working directory (git based tasks) should be chained with `needs`.
+    """
+
+    import yaml
+    from gadget import tasks
+    from gadget.tasks import init, utils
+
+    with open(plan, 'rb') as fh:
+        document = yaml.load(fh.read(), Loader=utils.YAML_LOADER)
+
+    try:
+        steps = expand(document.get('steps') or [])
+    except (KeyError, ValueError) as e:
+        raise Exit(f"Invalid plan {plan}: {e}", code=1)
+
+    ns = tasks.load_namespace({step['task'].split('.')[0] for step in steps})
+
+    try:
+        resolved = {step['name']: ns[step['task']] for step in steps}
+    except (KeyError, ValueError) as e:
+        raise Exit(f"Invalid plan {plan}: {e}", code=1)
+
+    #
+    # Pre tasks (config and client init) run once, serially, before any step
+    #
+    init.load_conf(ctx, config=config or document.get('config'))
+    done = {init.load_conf}
+
+    for step in steps:
+        prepare(ctx, resolved[step['name']], done)
+
+    workers = int(concurrency or document.get('concurrency') or 4)
+    pending = {step['name']: step for step in steps}
+    results = {}
+    running = {}
+
+    logging.info(f"Running {len(steps)} steps with {workers} workers")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name, step in list(pending.items()):
+                needs = step.get('needs', [])
+
+                if any(results.get(need, (None,))[0] in ('failed', 'skipped') for need in needs):
+                    results[name] = ('skipped', 0, 'dependency failed')
+                    del pending[name]
+                elif all(results.get(need, (None,))[0] == 'ok' for need in needs):
+                    running[pool.submit(run_step, ctx, resolved[name], step)] = name
+                    del pending[name]
+
+            if not running:
+                for name in pending:
+                    results[name] = ('skipped', 0, 'dependency cycle')
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                results[running.pop(future)] = future.result()
+
+    table = Table("Step", "Task", "Status", "Seconds", "Error", title=f"Plan({len(steps)})")
+
+    for step in steps:
+        status, seconds, error = results[step['name']]
+        table.add_row(step['name'], step['task'], status, f"{seconds:.2f}", error or "")
+
+    console.print(table)
+
+    failed = [name for name, result in results.items() if result[0] != 'ok']
+
+    if failed:
+        raise Exit(f"{len(failed)} of {len(steps)} steps did not complete", code=1)
@@ -0,0 +1,238 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+#
+# Shared work scheduler for bulk tasks. Work runs on one bounded pool and
+# every HTTP request made through gadget.transport takes a token from the
+# bucket of its host first. A 429 (or 503 with Retry-After) halves the rate
+# of that host and pauses it, successful calls slowly raise it back.
+#
+settings = {
+    'workers': int(os.environ.get('GADGET_WORKERS', 8)),
+    'retries': 5,
+    # Requests per second, matched on the host name suffix
+    'limits': {
+        'api.bitbucket.org': 10,
+        'jfrog.io': 20,
+        'digicert.com': 3,
+        'graph.microsoft.com': 10,
+        'atlassian.net': 10,
+    },
+}
+
+_lock = threading.Lock()
+_buckets = {}
+_scheduler = None
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket with additive increase / multiplicative decrease
+    of its rate.
+    """
+
+    def __init__(self, rate, burst=None, min_rate=0.1):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+
+                    delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+    def throttle(self, delay):
+        """
+        :param delay: float, Seconds to pause the bucket for
+        """
+
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+        logging.warning(f"Rate limited, slowing down to {self.rate:.2f} req/s for {delay:.1f}s")
+
+    def recover(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+
+def configure(workers=None, retries=None, limits=None):
+    """
+    Updates the scheduler settings, usually from the `scheduler` section of gadget.yaml
+
+    :param workers: int, Size of the shared worker pool
+    :param retries: int, Retries of a rate limited request
+    :param limits: dict, Requests per second keyed on host name suffix
+    """
+
+    global _scheduler
+
+    old = None
+
+    # Called before every task, the pool and buckets are only replaced when their settings change
+    with _lock:
+        if workers is not None and int(workers) != settings['workers']:
+            settings['workers'] = int(workers)
+            old, _scheduler = _scheduler, None
+        if retries is not None:
+            settings['retries'] = int(retries)
+        if limits and any(settings['limits'].get(host) != rate for host, rate in limits.items()):
+            settings['limits'].update(limits)
+            _buckets.clear()
+
+    # Work already submitted finishes on the old pool
+    if old is not None:
+        old.pool.shutdown(wait=False)
+
+
+def bucket(host):
+    """
+    :param host: string, The request host name
+    :return TokenBucket: The bucket for the host, None if it is not limited
+    """
+
+    if not host:
+        return None
+
+    with _lock:
+        if host not in _buckets:
+            rate = next(
+                (rate for suffix, rate in settings['limits'].items() if host == suffix or host.endswith(f".{suffix}")),
+                None
+            )
+            _buckets[host] = TokenBucket(rate) if rate else None
+
+        return _buckets[host]
+
+
+def retry_after(headers, attempt):
+    """
+    :param headers: dict, The response headers
+    :param attempt: int, Number of retries made so far
+    :return float: Seconds to wait before retrying
+    """
+
+    value = headers.get('Retry-After')
+
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+            except (TypeError, ValueError):
+                pass
+
+    return min(60.0, 2 ** attempt)
+
+
+class Scheduler:
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gadget')
+        self.lock = threading.Lock()
+
+    def grow(self, workers):
+        """
+        Replaces the pool with a larger one, work already submitted finishes on the old pool
+
+        :param workers: int, The new pool size
+        """
+
+        with self.lock:
+            if workers <= self.workers:
+                return
+
+            logging.info(f"Growing the worker pool from {self.workers} to {workers}")
+            old, self.pool = self.pool, ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gadget')
+            self.workers = workers
+            old.shutdown(wait=False)
+
+    def submit(self, fn, *args, **kwargs):
+        # Work inherits the caller's context (eg: the http cache policy)
+        with self.lock:
+            return self.pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+    def run(self, fn, items, limit=None):
+        """
+        Runs fn(item) for every item with at most `limit` calls in flight.
+        Items are pulled lazily so large or streamed inputs stay bounded.
+
+        :param fn: callable, Called with each item
+        :param items: iterable, The work items
+        :param limit: int, Max calls in flight, the pool grows when it is smaller.
+            Requests are still bound by the rate limit of their host.
+        :return generator: (item, result, error) tuples as calls complete. When
+            pulling from `items` raises, the calls in flight are yielded first.
+        """
+
+        limit = max(1, int(limit or self.workers))
+        self.grow(limit)
+        in_flight = {}
+
+        def drain(return_when):
+            done, _ = wait(list(in_flight), return_when=return_when)
+
+            for future in done:
+                item = in_flight.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+
+        try:
+            for item in items:
+                while len(in_flight) >= limit:
+                    yield from drain(FIRST_COMPLETED)
+
+                in_flight[self.submit(fn, item)] = item
+        except Exception:
+            # The input failed (eg: a page of a streamed search), hand back the
+            # calls already running so the caller can account for them first
+            while in_flight:
+                yield from drain(FIRST_COMPLETED)
+            raise
+
+        while in_flight:
+            yield from drain(FIRST_COMPLETED)
+
+
+def scheduler():
+    """
+    :return Scheduler: The process wide scheduler
+    """
+
+    global _scheduler
+
+    with _lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(settings['workers'])
+
+        return _scheduler
@@ -0,0 +1,166 @@
+import io
+import json
+import logging
+import os
+import socket as sockets
+import sys
+import traceback
+
+from invoke import task
+from gadget import client
+
+
+class Output(io.TextIOBase):
+    """
+    Stands in for sys.stdout/sys.stderr while serving. Writes go to the
+    connection of the command being run, or to the real stream between
+    commands.
+    """
+
+    def __init__(self, stream, default):
+        self.stream = stream
+        self.default = default
+        self.conn = None
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    def isatty(self):
+        return False if self.conn else self.default.isatty()
+
+    def write(self, data):
+        if self.conn is None:
+            return self.default.write(data)
+
+        try:
+            self.conn.sendall((json.dumps({'stream': self.stream, 'data': data}) + '\n').encode('utf-8'))
+        except OSError:
+            # Client hung up, keep running the command without output
+            self.conn = None
+
+        return len(data)
+
+    def flush(self):
+        if self.conn is None:
+            self.default.flush()
+
+
+def warm_up():
+    """
+    Imports every task collection and points module level consoles at the
+    redirected streams
+    """
+
+    import rich
+    from rich.console import Console
+    from rich.logging import RichHandler
+    from gadget import tasks
+
+    for name in tasks.COLLECTIONS:
+        try:
+            tasks.load_collection(name)
+        except Exception as e:
+            logging.warning(f"Unable to preload {name}: {e}")
+
+    rich.get_console().file = sys.stdout
+
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, RichHandler):
+            handler.console.file = sys.stderr
+
+    for name, module in list(sys.modules.items()):
+        console = getattr(module, 'console', None) if name.startswith('gadget.') else None
+
+        if isinstance(console, Console):
+            console.file = sys.stdout
+
+
+def handle(conn):
+    """
+    Runs one forwarded command, streaming its output back to the client
+
+    :param conn: socket, The client connection
+    """
+
+    from gadget import main
+
+    request = json.loads(conn.makefile('r', encoding='utf-8').readline())
+    code = 0
+    cwd = os.getcwd()
+
+    if request['argv'][:1] == ['serve']:
+        conn.sendall((json.dumps({'stream': 'stderr', 'data': "Already serving\n"}) + '\n').encode('utf-8'))
+        conn.sendall((json.dumps({'exit': 1}) + '\n').encode('utf-8'))
+        return
+
+    logging.debug(f"Running: {request['argv']}")
+    sys.stdout.conn = conn
+    sys.stderr.conn = conn
+
+    try:
+        os.chdir(request['cwd'])
+        main.make_program().run(argv=['gadget'] + request['argv'])
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            code = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            code = 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.conn = None
+        sys.stderr.conn = None
+        os.chdir(cwd)
+
+    try:
+        conn.sendall((json.dumps({'exit': code}) + '\n').encode('utf-8'))
+    except OSError:
+        pass
+
+
+@task
+def serve(ctx, socket=None):
+    """ Run a warm gadget server, forward commands to it with GADGET_SOCKET
+    Parameter
+    ================
+    socket: Location of the unix socket, defaults to ~/.cache/gadget/gadget.sock
+    """
+
+    path = socket or client.socket_path()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if os.path.exists(path):
+        os.unlink(path)
+
+    sys.stdout = Output('stdout', sys.stdout)
+    sys.stderr = Output('stderr', sys.stderr)
+    warm_up()
+
+    server = sockets.socket(sockets.AF_UNIX, sockets.SOCK_STREAM)
+    umask = os.umask(0o177)
+
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+
+    server.listen(16)
+    logging.info(f"Gadget server listening on {path}")
+
+    try:
+        while True:
+            conn, _ = server.accept()
+
+            with conn:
+                try:
+                    handle(conn)
+                except Exception as e:
+                    logging.error(f"Failed to handle request: {e}")
+    except KeyboardInterrupt:
+        logging.info("Shutting down gadget server")
+    finally:
+        server.close()
+        os.unlink(path)
@@ -0,0 +1,111 @@
+import json
+import os
+import pkgutil
+import subprocess
+import sys
+import time
+
+from gadget import tasks
+
+#
+# Runs in a fresh interpreter so every measurement is a cold import. Prints a
+# single json document to stdout.
+#
+PROBE = '''
+import io, json, locale, sys, time
+
+def maxrss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+name = sys.argv[1]
+result = {"module": name, "error": None}
+
+start = time.perf_counter()
+import gadget.tasks
+result["base_seconds"] = time.perf_counter() - start
+
+locale_before = locale.setlocale(locale.LC_ALL)
+modules_before = len(sys.modules)
+rss_before = maxrss()
+stdout, sys.stdout = sys.stdout, io.StringIO()
+
+start = time.perf_counter()
+try:
+    if name == "namespace":
+        gadget.tasks.load_namespace(set())
+    else:
+        __import__("gadget.tasks." + name)
+except Exception as e:
+    result["error"] = f"{type(e).__name__}: {e}"
+
+result["seconds"] = time.perf_counter() - start
+captured, sys.stdout = sys.stdout.getvalue(), stdout
+
+result["maxrss_kb"] = maxrss()
+result["maxrss_delta_kb"] = None if rss_before is None else result["maxrss_kb"] - rss_before
+result["modules_loaded"] = len(sys.modules) - modules_before
+result["stdout"] = captured
+result["locale_changed"] = locale.setlocale(locale.LC_ALL) != locale_before
+
+print(json.dumps(result))
+'''
+
+
+def probe(name, python=None):
+    """
+    :param name: string, Task module to import, or `namespace` for the lazy root namespace
+    :param python: string, The interpreter to profile with, defaults to the current one
+    :return dict: The measurements taken by the probe
+    """
+
+    env = dict(os.environ)
+    source_root = os.path.dirname(os.path.dirname(os.path.abspath(tasks.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [source_root, env.get('PYTHONPATH')]))
+
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [python or sys.executable, '-c', PROBE, name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+    )
+    elapsed = time.perf_counter() - start
+
+    try:
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        result = {'module': name, 'error': proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else 'no output'}
+
+    result['process_seconds'] = elapsed
+    return result
+
+
+def profile_startup(modules=None, python=None):
+    """
+    Measures the cold start of gadget and of every task module
+
+    :param modules: list, Task modules to profile, defaults to every module in gadget.tasks
+    :param python: string, The interpreter to profile with
+    :return dict: Machine readable startup report
+    """
+
+    modules = modules or sorted(item.name for item in pkgutil.iter_modules(tasks.__path__))
+
+    report = {
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'namespace': probe('namespace', python=python),
+        'modules': [probe(name, python=python) for name in modules],
+    }
+
+    report['side_effects'] = [
+        item['module'] for item in report['modules'] if item.get('stdout') or item.get('locale_changed')
+    ]
+
+    return report
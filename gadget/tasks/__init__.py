@@ -1,36 +1,158 @@
-
+import ast
+import importlib
+import importlib.util
 import logging
-from invoke import config, Collection
+import sys
+from invoke import config, Collection, Task
+from rich.console import Console
 from rich.logging import RichHandler
 
-from gadget.tasks import (
-    init,
-    artifactory,
-    servicedesk,
-    azure,
-    tls,
-    jira,
-    kubernetes,
-    utils,
-    bitbucket,
-    hvault,
-    digicert,
-    logdna
+#
+# Task modules registered with the gadget program. Modules are only imported
+# when one of their tasks is invoked, every other namespace is described by
+# scanning the module source for @task definitions.
+#
+COLLECTIONS = (
+    'init',
+    'bitbucket',
+    'jira',
+    'servicedesk',
+    'utils',
+    'artifactory',
+    'tls',
+    'kubernetes',
+    'azure',
+    'hvault',
+    'digicert',
+    'logdna',
 )
 
-ns = Collection()
-ns.add_collection(init)
-ns.add_collection(bitbucket)
-ns.add_collection(jira)
-ns.add_collection(servicedesk)
-ns.add_collection(utils)
-ns.add_collection(artifactory)
-ns.add_collection(tls)
-ns.add_collection(kubernetes)
-ns.add_collection(azure)
-ns.add_collection(hvault)
-ns.add_collection(digicert)
-ns.add_collection(logdna)
+
+def _task_decorator(node):
+    """
+    :param node: ast.expr, A decorator node
+    :return ast.expr: The decorator node if it is an invoke @task, otherwise None
+    """
+
+    target = node.func if isinstance(node, ast.Call) else node
+
+    if isinstance(target, ast.Name) and target.id == 'task':
+        return node
+    if isinstance(target, ast.Attribute) and target.attr == 'task':
+        return node
+
+
+def scan_module(name):
+    """
+    Lists the tasks defined in a task module without importing it
+
+    :param name: string, The task module name (eg: bitbucket)
+    :return list: List of (function name, docstring, is default) tuples, None if the source is unavailable
+    """
+
+    spec = importlib.util.find_spec(f"gadget.tasks.{name}")
+
+    if spec is None or not spec.origin or not spec.origin.endswith('.py'):
+        return None
+
+    with open(spec.origin, 'rb') as fh:
+        tree = ast.parse(fh.read(), filename=spec.origin)
+
+    results = []
+
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+
+        for decorator in node.decorator_list:
+            decorator = _task_decorator(decorator)
+
+            if decorator is None:
+                continue
+
+            default = False
+
+            if isinstance(decorator, ast.Call):
+                for keyword in decorator.keywords:
+                    if keyword.arg == 'default':
+                        default = bool(getattr(keyword.value, 'value', False))
+
+            results.append((node.name, ast.get_docstring(node, clean=False), default))
+
+    return results
+
+
+def load_collection(name):
+    """
+    :param name: string, The task module name
+    :return Collection: The collection built from the imported task module
+    """
+
+    from gadget import metrics
+
+    logging.debug(f"Loading task collection: {name}")
+    return metrics.instrument(Collection.from_module(importlib.import_module(f"gadget.tasks.{name}")))
+
+
+def lazy_collection(name):
+    """
+    Builds a collection of placeholder tasks from the module source. The
+    placeholders carry the task names and docstrings for listing and help,
+    and import the real module if they are ever called.
+
+    :param name: string, The task module name
+    :return Collection: Collection of placeholder tasks
+    """
+
+    scanned = scan_module(name)
+
+    if scanned is None:
+        return load_collection(name)
+
+    collection = Collection(name)
+
+    for func_name, doc, default in scanned:
+        def body(c, _func=func_name):
+            module = importlib.import_module(f"gadget.tasks.{name}")
+            return getattr(module, _func)(c)
+
+        body.__name__ = func_name
+        body.__doc__ = doc
+        collection.add_task(Task(body), default=default)
+
+    return collection
+
+
+def load_namespace(requested=None):
+    """
+    Builds the root gadget namespace
+
+    :param requested: iterable, Names of the collections to import, None imports all of them
+    :return Collection: The root collection
+    """
+
+    from gadget import plan, server
+
+    ns = Collection()
+    ns.add_task(server.serve)
+    ns.add_task(plan.run_plan)
+
+    for name in COLLECTIONS:
+        if requested is None or name in requested:
+            ns.add_collection(load_collection(name))
+        else:
+            ns.add_collection(lazy_collection(name))
+
+    return ns
+
+
+def __getattr__(name):
+    # Keep `gadget.tasks.ns` available as the fully imported namespace
+    if name == 'ns':
+        return load_namespace()
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 LOGGING_FORMAT = '[%(module)s:%(funcName)s:%(lineno)d] %(levelname)s: %(message)s'
 
@@ -38,5 +160,6 @@ logging.basicConfig(
     level=logging.INFO,
     format=LOGGING_FORMAT,
     datefmt="[%X]",
-    handlers=[RichHandler()]
+    # Logs go to stderr so task output (eg: --ndjson) can be piped
+    handlers=[RichHandler(console=Console(file=sys.stderr))]
 )
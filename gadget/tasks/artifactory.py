@@ -1,20 +1,57 @@
 import pathlib
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from gadget import metrics, scheduler, transport
 from gadget.tasks import init, utils
 from invoke import task, tasks
-from artifactory import ArtifactoryPath, ArtifactorySaaSPath
-from urllib.parse import urljoin
+from artifactory import ArtifactoryPath, ArtifactorySaaSPath, XJFrogArtApiAuth
+from urllib.parse import quote, urljoin
 from rich.console import Console
+from rich.progress import BarColumn, Progress, TextColumn, TimeRemainingColumn
 from rich.table import Table
 from jinja2 import Template
+from contextlib import nullcontext
 import requests
-import _thread
-import time
+import fnmatch
 import logging
+import json
 import os
+import re
+import sys
+import time
 
 console = Console()
 
+# Sessions keyed on (server, username), shared by every path object
+_sessions = {}
+
+
+def session(conf):
+    """
+    :param conf: dict, The artifactory config (server, username, password)
+    :return requests.Session: The pooled session for the server
+    """
+
+    key = (conf.server, conf.get('username'))
+
+    if key not in _sessions:
+        if conf.get('apikey'):
+            auth = XJFrogArtApiAuth(conf.password)
+        else:
+            auth = (conf.username, conf.password)
+
+        _sessions[key] = transport.session(auth=auth)
+
+    return _sessions[key]
+
+
+def server_url(conf):
+    """
+    :param conf: dict, The artifactory config
+    :return string: The server url, https unless the server includes a scheme
+    """
+
+    return conf.server if '://' in conf.server else f"https://{conf.server}"
+
 
 def artifactory(conf, repo, path=None):
     """
@@ -25,7 +62,7 @@ def artifactory(conf, repo, path=None):
     :return ArtifactoryPath: ArtifactoryPath
     """
 
-    base_url = f"https://{conf.server}/artifactory"
+    base_url = f"{server_url(conf)}/artifactory"
 
     if path is not None:
         url = f"{base_url}/{repo}/{path}"
@@ -33,9 +70,9 @@ def artifactory(conf, repo, path=None):
         url = f"{base_url}/{repo}"
 
     if conf.get('apikey'):
-        return ArtifactorySaaSPath(url, apikey=conf.password)
+        return ArtifactorySaaSPath(url, apikey=conf.password, session=session(conf))
     else:
-        return ArtifactorySaaSPath(url, auth=(conf.username, conf.password))
+        return ArtifactorySaaSPath(url, auth=(conf.username, conf.password), session=session(conf))
 
 
 def get_url(list):
@@ -117,8 +154,19 @@ def upload(ctx, artifact, repo, repo_path=None, server=None, properties=None):
 
 
 @task(pre=[init.load_conf])
-def artifact_cleanup(ctx, repo, date, purge=False, output=False, threads=5):
-    art = artifactory(ctx.config.main.artifactory, repo)
+def artifact_cleanup(ctx, repo, date, purge=False, output=False, threads=5, audit=None, coalesce=False):
+    """
+    Artifact cleanup task
+    :param ctx: Context, Invoke context
+    :param repo: string, The artifactory repo to target
+    :param date: string, Artifacts last updated before this date are deleted
+    :param purge: bool, Toggle for purging the artifacts
+    :param output: bool, Toggle for printing a table of artifacts found
+    :param threads: int, Max deletes in flight, the shared worker pool grows to match
+    :param audit: string, Write the outcome of every delete to this ndjson file
+    :param coalesce: bool, Delete a folder whose files all match with one delete
+    """
+    conf = ctx.config.main.artifactory
 
     query = Template(
         '''
@@ -133,8 +181,7 @@ def artifact_cleanup(ctx, repo, date, purge=False, output=False, threads=5):
         '''
     )
 
-    aql_query = query.render(date=date, repo=repo)
-    results = art.aql(art.create_aql_text(aql_query.replace('\n', '').replace(' ', '')))
+    aql_query = format_aql_query(query.render(date=date, repo=repo))
 
     table = Table(
         "File",
@@ -145,59 +192,39 @@ def artifact_cleanup(ctx, repo, date, purge=False, output=False, threads=5):
 
     input_datefmt = '%Y-%m-%dT%H:%M:%S.%fZ'
 
-    if len(results) < 1:
-        logging.info("No artifacts to process")
-        exit(0)
-
-    logging.info(f"{len(results)} to process")
-
-    for item in results:
+    def add_row(item):
         table.add_row(
             f"{item['repo']}:{item['path']}/{item['name']}",
             datetime.strftime(datetime.strptime(item['created'], input_datefmt), '%b %d %Y'),
             datetime.strftime(datetime.strptime(item['updated'], input_datefmt), '%b %d %Y')
         )
 
+    found = cleanup(
+        conf, repo, aql_query, ('created', 'updated'), item_path, add_row if output else None,
+        purge=purge, threads=threads, audit=audit, coalesce=coalesce,
+    )
+
     if output:
-        table.add_row(f"Results: {len(results)}")
+        table.add_row(f"Results: {found}")
         console.print(table)
 
-    if purge:
-        while len(results) > 0:
-            for num in range(threads):
-                try:
-                    artifact = results.pop()
-                    artifact_path = f"{artifact['path']}/{artifact['name']}"
-                    _thread.start_new_thread(
-                        delete_artifact,
-                        (ctx.config.main.artifactory, repo, artifact_path, f"Thread-{num}")
-                    )
-                except IndexError:
-                    break
-            time.sleep(.500)
-
-        # for item in results:
-        #     art = artifactory(ctx.config.main.artifactory, item['repo'], path=item['path'])
-        #     logging.info(f"Deleting artifact: {item['repo']}:{item['path']}/{item['name']}")
-        #
-        #     try:
-        #         art.unlink()
-        #     except FileNotFoundError:
-        #         logging.info(f"File not found: {item['repo']}:{item['path']}/{item['name']}")
-
 
 @task(pre=[init.load_conf])
-def container_cleanup(ctx, repo, date, pathmatch='*', threads=5, purge=False, output=False):
+def container_cleanup(ctx, repo, date, pathmatch='*', threads=5, purge=False, output=False, audit=None,
+                      coalesce=False):
     """
     Docker cleanup task
     :param ctx: Context, Invoke context
     :param repo: string, The artifactory docker repo to target
     :param date: string, The age of the images to target
     :param pathmatch: string, Additional path match criteria to check
+    :param threads: int, Max deletes in flight, the shared worker pool grows to match
     :param purge: bool, Toggle for purging containers
     :param table: bool, Toggle for printing a table of images found
+    :param audit: string, Write the outcome of every delete to this ndjson file
+    :param coalesce: bool, Delete an image whose tags all match with one delete
     """
-    art = artifactory(ctx.config.main.artifactory, repo)
+    conf = ctx.config.main.artifactory
 
     query = Template(
         '''
@@ -221,16 +248,8 @@ def container_cleanup(ctx, repo, date, pathmatch='*', threads=5, purge=False, ou
         '''
     )
 
-    aql_query = query.render(date=date, repo=repo, pathmatch=pathmatch)
-
-    try:
-        logging.debug(aql_query)
-        # breakpoint()
-
-        results = art.aql(art.create_aql_text(aql_query.replace('\n', '').replace(' ', '')))
-    except requests.exceptions.HTTPError:
-        logging.error("Invalid AQL query")
-        exit(1)
+    aql_query = format_aql_query(query.render(date=date, repo=repo, pathmatch=pathmatch))
+    logging.debug(aql_query)
 
     table = Table(
         "File",
@@ -241,67 +260,148 @@ def container_cleanup(ctx, repo, date, pathmatch='*', threads=5, purge=False, ou
 
     input_datefmt = '%Y-%m-%dT%H:%M:%S.%fZ'
 
-    if len(results) < 1:
-        logging.info("No results to show")
-        exit(0)
-
-    for item in results:
+    def add_row(item):
         table.add_row(
             f"{item['repo']}:{item['path']}/{item['name']}",
             datetime.strftime(datetime.strptime(item['updated'], input_datefmt), '%b %d %Y'),
         )
 
-    table.add_row(f"{len(results)} items")
+    found = cleanup(
+        conf, repo, aql_query, ('updated',), lambda item: item['path'], add_row if output else None,
+        purge=purge, threads=threads, audit=audit, coalesce=coalesce,
+    )
+
+    table.add_row(f"{found} items")
 
     if output:
         console.print(table)
 
-    logging.info(f"{len(results)} to process")
-
-    if purge:
-        while len(results) > 0:
-            for num in range(threads):
-                try:
-                    artifact = results.pop()
-                    _thread.start_new_thread(
-                        delete_artifact,
-                        (ctx.config.main.artifactory, repo, artifact['path'], f"Thread-{num}")
-                    )
-                except IndexError:
-                    break
-            time.sleep(.500)
-
 
 @task(pre=[init.load_conf])
-def folder_cleanup(ctx, repo, path, threads=5, purge=False, output=False):
+def docker_retention(ctx, repo, keep=10, downloaded=None, semver=False, keep_tags='latest', pathmatch='*',
+                     threads=5, purge=False, output=False, audit=None):
     """
-    Docker cleanup task
+    Docker tag retention task, every tag kept by none of the policies is deleted
     :param ctx: Context, Invoke context
     :param repo: string, The artifactory docker repo to target
-    :param date: string, The age of the images to target
+    :param keep: int, Keep the last N updated tags of every image
+    :param downloaded: int, Keep tags downloaded in the last N days
+    :param semver: bool, Keep release tags (eg: 1.2.3, v1.2.3)
+    :param keep_tags: string, Comma separated tag patterns that are always kept
     :param pathmatch: string, Additional path match criteria to check
-    :param purge: bool, Toggle for purging containers
-    :param table: bool, Toggle for printing a table of images found
+    :param threads: int, Max deletes in flight, the shared worker pool grows to match
+    :param purge: bool, Toggle for purging the tags, otherwise only the plan is printed
+    :param output: bool, Toggle for printing every tag to delete
+    :param audit: string, Write the outcome of every delete to this ndjson file
     """
-    art = artifactory(ctx.config.main.artifactory, repo)
+    conf = ctx.config.main.artifactory
+
+    aql_query = format_aql_query(
+        Template('''
+        items.find(
+            {
+                "type": "file",
+                "repo": "{{repo}}",
+                "$or": [
+                    {"name": "manifest.json"},
+                    {"name": "list.manifest.json"}
+                ],
+                "$and": [
+                    {"path": {"$match": "{{pathmatch}}"}},
+                    {"path": {"$nmatch": "*/sha256*"}}
+                ]
+            }
+        )
+        ''').render(repo=repo, pathmatch=pathmatch)
+    )
+
+    try:
+        rows = aql_stream(conf, aql_query, include=('updated', 'stat.downloaded', '@docker.repoName'))
+        images = plan_retention(
+            rows, keep=int(keep), downloaded=downloaded and int(downloaded), semver=semver,
+            keep_tags=[pattern for pattern in keep_tags.split(',') if pattern],
+        )
+    except requests.exceptions.HTTPError:
+        # aql_stream logged why the search failed
+        sys.exit(1)
+
+    deletes = [tag for tags in images.values() for tag in tags if tag['reason'] is None]
+    metrics.count('tags_found', sum(len(tags) for tags in images.values()))
+    metrics.count('tags_expired', len(deletes))
+
+    table = Table("Image", "Tags", "Kept", "Delete", title=f"Retention({repo})")
+
+    for image, tags in sorted(images.items(), key=lambda item: -sum(tag['reason'] is None for tag in item[1])):
+        expired = sum(tag['reason'] is None for tag in tags)
+
+        if expired or output:
+            table.add_row(image, str(len(tags)), str(len(tags) - expired), str(expired))
+
+    table.add_row(f"{len(images)} images", str(sum(len(tags) for tags in images.values())), "", str(len(deletes)))
+    console.print(table)
+
+    if output:
+        tags_table = Table("Tag", "Updated", "Downloaded", title="Expired tags")
+
+        for tag in deletes:
+            tags_table.add_row(f"{tag['image']}:{tag['tag']}", tag['updated'][:10], (tag['downloaded'] or '')[:10])
+
+        console.print(tags_table)
+
+    if purge and deletes:
+        summary = purge_paths(conf, repo, [tag['path'] for tag in deletes], threads=threads, total=len(deletes), audit=audit)
+
+        if summary['failed']:
+            sys.exit(1)
+
+
+@task(pre=[init.load_conf])
+def folder_cleanup(ctx, repo, path='', threads=5, purge=False, output=False, top=20, depth=1):
+    """
+    Folder size report, built from one deep storage listing of the path
+    :param ctx: Context, Invoke context
+    :param repo: string, The artifactory repo to target
+    :param path: string, The folder to report on, defaults to the whole repo
+    :param top: int, Number of largest folders to show
+    :param depth: int, Report folders this many levels below path (eg: 1 for the images of a docker repo)
+    :param output: bool, Toggle for showing every folder instead of the top ones
+    """
+    if purge:
+        logging.warning("folder-cleanup only reports folder sizes, nothing is deleted")
+
+    index = folder_index(ctx.config.main.artifactory, repo, path)
+    path = path.strip('/')
+    total = index.get(path, [0, 0, ''])
+    base = len(path.split('/')) if path else 0
+
+    folders = sorted(
+        (
+            (folder, entry) for folder, entry in index.items()
+            if folder and len(folder.split('/')) == base + int(depth) and (not path or folder.startswith(f"{path}/"))
+        ),
+        key=lambda item: item[1][0],
+        reverse=True,
+    )
 
     table = Table(
         "Path",
+        "Size(MB)",
+        "Files",
+        "Share",
         "Updated",
-        "Downloaded",
-        title="Artifacts",
+        title=f"Folders({len(folders)})",
     )
 
-    input_datefmt = '%Y-%m-%dT%H:%M:%S.%fZ'
+    for folder, (size, files, updated) in folders if output else folders[:int(top)]:
+        table.add_row(
+            f"{repo}:{folder}", f"{size / 1024 / 1024:.1f}", str(files),
+            f"{size / max(total[0], 1):.1%}", updated[:10],
+        )
+
+    table.add_row(f"{repo}:{path or '/'}", f"{total[0] / 1024 / 1024:.1f}", str(total[1]), "100.0%", total[2][:10])
+    console.print(table)
 
-    #
-    # Get the children
-    #
-    for path in art:
-        if path.is_dir():
-            for item in path.stat().children:
-                    for child in path.stat().children:
-                        console.print(f"Path: {item} size: {path.stat().size}")
+    return index
 
 
 @task(pre=[init.load_conf])
@@ -362,25 +462,551 @@ def get_container(ctx, repo, container_name, container_tag):
         exit(1)
 
 
-def delete_artifact(conf, repo, artifact_path, thread):
-    art = artifactory(conf, repo, path=artifact_path)
+# Rows per AQL page, every page is one search request
+AQL_PAGE_SIZE = 10000
+
+# Fields every streamed row includes, they are also the stable sort order
+AQL_KEY = ('repo', 'path', 'name')
+
+
+def aql_stream(conf, aql_query, include=(), page_size=AQL_PAGE_SIZE, removed=None):
+    """
+    Runs an items.find() query page by page and yields its rows, so a search
+    over millions of items runs in constant memory and its rows can be used
+    before the search is done. Only the AQL_KEY and `include` fields are
+    requested and pages are sorted on AQL_KEY so offsets are stable.
+
+    AQL only sorts and pages queries that include item fields. When `include`
+    asks for other domains (eg: stat.downloaded, @docker.repoName) the query is
+    sent once without sort, offset and limit and all of its rows are yielded.
+
+    When the rows are deleted while streaming, pass `removed` so the offsets
+    of the following pages account for the rows that no longer match. Rows
+    seen on the previous page are skipped, a delete still in flight when a
+    page is requested makes that page overlap the previous one.
+
+    :param conf: dict, The artifactory config
+    :param aql_query: string, The items.find(...) part of the query
+    :param include: tuple, Extra fields to return
+    :param page_size: int, Rows per page
+    :param removed: callable, Returns how many of the yielded rows were (or are being) deleted
+    :return generator: The rows
+    """
+
+    fields = ', '.join(json.dumps(field) for field in AQL_KEY + tuple(f for f in include if f not in AQL_KEY))
+    sort = json.dumps({'$asc': list(AQL_KEY)})
+    url = f"{server_url(conf)}/artifactory/api/search/aql"
+    # Item fields are plain names, stat.* and @property fields belong to other domains
+    paged = not any('.' in field or field.startswith('@') for field in include)
+    yielded = 0
+    previous = set()
+
+    while True:
+        offset = yielded - (removed() if removed and paged else 0)
+
+        if paged:
+            text = f"{aql_query}.include({fields}).sort({sort}).offset({offset}).limit({page_size})"
+        else:
+            text = f"{aql_query}.include({fields})"
+        response = session(conf).post(url, data=text, headers={'Content-Type': 'text/plain'})
+
+        if not response.ok:
+            reason = "Invalid AQL query" if response.status_code == 400 else "AQL search failed"
+            logging.error(f"{reason} at offset {offset}: {response.status_code} {response.text[:500]}")
+            response.raise_for_status()
+
+        rows = response.json().get('results', [])
+        page = set()
+        start = yielded
+
+        for item in rows:
+            key = tuple(item.get(field) for field in AQL_KEY)
+            page.add(key)
+
+            if key in previous:
+                continue
+
+            yielded += 1
+            yield item
+
+        logging.debug(f"AQL page at offset {offset}: {len(rows)} rows")
+
+        if not paged or len(rows) < page_size:
+            return
+
+        if yielded == start and removed:
+            # Deleted rows still match, page on the rows seen instead
+            logging.warning("Deleted rows are still returned by the search, paging without them")
+            removed = None
+
+        previous = page
+
+
+def cleanup(conf, repo, aql_query, include, to_path, add_row=None, purge=False, threads=5, audit=None, coalesce=False):
+    """
+    Streams the rows of a cleanup query and, with purge, deletes them. With
+    coalesce the matched paths are planned into folder deletes first (see
+    `plan_purge`), otherwise deletes start while the search is still paging.
+
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param aql_query: string, The items.find(...) part of the query
+    :param include: tuple, Extra fields `add_row` uses
+    :param to_path: callable, Returns the path to delete for a row
+    :param add_row: callable, Called with every row (eg: to fill the output table)
+    :return int: Number of rows found, exits 1 when the search or a delete failed
+    """
+
+    state = {}
+    found = [0]
+
+    def rows():
+        removed = (lambda: state.get('submitted', 0) - state.get('failed', 0)) if purge and not coalesce else None
+
+        for item in aql_stream(conf, aql_query, include=include, removed=removed):
+            found[0] += 1
+
+            if add_row:
+                add_row(item)
+
+            yield item
 
     try:
-        art.unlink()
-        logging.info(f"{thread}: Deleted artifact: {art.repo}{art.path_in_repo}")
-    except FileNotFoundError as e:
-        logging.info(f"{thread}: File not found: {art.repo}{art.path_in_repo}")
-        logging.error(e)
+        if not purge:
+            for _ in rows():
+                pass
+        elif coalesce:
+            paths = [to_path(item) for item in rows()]
+
+            if paths:
+                operations = {operation[0]: operation for operation in plan_purge(conf, repo, paths)}
+                state = purge_paths(
+                    conf, repo, list(operations), threads=threads, total=len(operations), audit=audit,
+                    delete=lambda path: delete_planned(conf, repo, operations[path]),
+                )
+        else:
+            state = purge_paths(conf, repo, (to_path(item) for item in rows()), threads=threads, audit=audit, state=state)
+    except requests.exceptions.HTTPError:
+        # The search failed part way, deletes of the rows found before it have run
+        if state.get('submitted'):
+            logging.error(
+                f"Stopped purging {repo} after {found[0]} artifacts found: {state['deleted']} deleted, "
+                f"{state['missing']} missing, {state['failed']} failed"
+            )
+        sys.exit(1)
 
+    logging.info(f"{found[0]} artifacts found in {repo}")
+    metrics.count('artifacts_found', found[0])
 
-def delete_docker_tag(conf, artifact, thread):
-    art = artifactory(conf, artifact['repo'], path=artifact['path'])
+    if state.get('failed'):
+        sys.exit(1)
+
+    return found[0]
+
+
+def folder_index(conf, repo, path=''):
+    """
+    Lists every file below a folder in one request and rolls the file sizes
+    up into every folder above them
+
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param path: string, The folder to list, defaults to the whole repo
+    :return dict: Folder path (relative to the repo, '' for the root) -> [bytes, files, last updated]
+    """
+
+    path = path.strip('/')
+    url = f"{server_url(conf)}/artifactory/api/storage/{repo}/{quote(path)}"
+    response = session(conf).get(url, params='list&deep=1&listFolders=1&mdTimestamps=0')
+    response.raise_for_status()
+
+    prefix = f"{path}/" if path else ''
+    index = {path: [0, 0, '']}
+
+    for item in response.json().get('files', []):
+        file_path = f"{prefix}{item['uri'].strip('/')}"
+
+        if item.get('folder'):
+            index.setdefault(file_path, [0, 0, item.get('lastModified', '')])
+            continue
+
+        size = int(item.get('size') or 0)
+        updated = item.get('lastModified', '')
+        parts = file_path.split('/')
+
+        for num in range(len(path.split('/')) if path else 0, len(parts)):
+            entry = index.setdefault('/'.join(parts[:num]), [0, 0, ''])
+            entry[0] += size
+            entry[1] += 1
+
+            # Timestamps from one server share a format and compare as strings
+            if updated > entry[2]:
+                entry[2] = updated
+
+    logging.info(f"Indexed {index[path][1]} files in {len(index)} folders of {repo}:{path or '/'}")
+    return index
+
+
+# Release tags kept by the semver retention policy
+SEMVER = re.compile(r'^v?\d+\.\d+\.\d+$')
+
+
+def parse_time(value):
+    """
+    :param value: string, An artifactory timestamp (eg: 2020-01-01T00:00:00.000Z)
+    :return datetime: The timestamp, None when missing
+    """
+
+    if not value:
+        return None
+
+    value = value.replace('Z', '+00:00')
 
     try:
-        art.unlink()
-        logging.info(f"{thread}: Deleted tag: {artifact['repo']}:{artifact['path']}")
-    except FileNotFoundError:
-        logging.info(f"{thread}: File not found: {artifact['repo']}:{artifact['path']}")
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f%z')
+    except ValueError:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+
+def plan_retention(rows, keep=10, downloaded=None, semver=False, keep_tags=(), now=None):
+    """
+    Groups docker manifest rows (manifest.json, or list.manifest.json for
+    multi-arch tags) by image and applies the retention policies. Digest
+    folders of multi-arch images are skipped, they are never deleted.
+    A tag is kept when it is one of the `keep` last updated tags of its image,
+    was downloaded in the last `downloaded` days, is a semver release (with
+    `semver`) or matches one of `keep_tags`.
+
+    :param rows: iterable, AQL manifest rows with updated, stats and the docker.repoName property
+    :param keep: int, Number of last updated tags kept per image
+    :param downloaded: int, Keep tags downloaded within this many days
+    :param semver: bool, Keep semver release tags
+    :param keep_tags: list, Tag patterns that are always kept
+    :param now: datetime, The evaluation time, defaults to now
+    :return dict: Image name -> tags, newest first. Every tag is a dict with
+        image, tag, path, updated, downloaded and reason (why it is kept, None to delete)
+    """
+
+    now = now or datetime.now(timezone.utc)
+    since = now - timedelta(days=downloaded) if downloaded else None
+    images = {}
+
+    seen = set()
+
+    for item in rows:
+        properties = {prop['key']: prop.get('value') for prop in item.get('properties') or []}
+        folder, _, tag = item['path'].rpartition('/')
+        last_download = (item.get('stats') or [{}])[0].get('downloaded')
+
+        # sha256:<digest> folders hold the platform manifests of multi-arch tags, they are not tags
+        if tag.startswith('sha256') or item['path'] in seen:
+            continue
+
+        seen.add(item['path'])
+
+        images.setdefault(properties.get('docker.repoName') or folder, []).append({
+            'image': properties.get('docker.repoName') or folder,
+            'tag': tag,
+            'path': item['path'],
+            'updated': item.get('updated') or '',
+            'downloaded': last_download,
+            'sort': (parse_time(item.get('updated')) or datetime.min.replace(tzinfo=timezone.utc), tag),
+            'reason': None,
+        })
+
+    for tags in images.values():
+        tags.sort(key=lambda tag: tag.pop('sort'), reverse=True)
+
+        for num, tag in enumerate(tags):
+            if num < keep:
+                tag['reason'] = f"last {keep}"
+            elif any(fnmatch.fnmatch(tag['tag'], pattern) for pattern in keep_tags):
+                tag['reason'] = 'pinned'
+            elif since and tag['downloaded'] and parse_time(tag['downloaded']) >= since:
+                tag['reason'] = 'downloaded'
+            elif semver and SEMVER.match(tag['tag']):
+                tag['reason'] = 'release'
+
+    return images
+
+
+def item_path(item):
+    """
+    :param item: dict, An AQL result row
+    :return string: The path of the item within its repo
+    """
+
+    return item['name'] if item['path'] in ('', '.') else f"{item['path']}/{item['name']}"
+
+
+def ancestors(path):
+    """
+    :param path: string, A path within a repo (eg: org/app/1.0/app.jar)
+    :return list: The folders above the path, outermost first (eg: org, org/app, org/app/1.0)
+    """
+
+    parts = path.split('/')
+    return ['/'.join(parts[:num]) for num in range(1, len(parts))]
+
+
+def plan_deletes(selected, files):
+    """
+    Collapses the paths to delete into fewer deletes. A path whose parent
+    folder only holds selected files is deleted with its parent instead. Only
+    the nearest folder is considered, so a purge never widens to whole
+    components or groups (eg: org, org/app) and the repo root is never deleted.
+
+    :param selected: iterable, File or folder paths to delete
+    :param files: iterable, (path, size) of every file in the repo
+    :return list: (path, kind, files, bytes, members) of every delete, kind is folder or file
+        and members are the selected paths the delete covers
+    """
+
+    selected = {path.strip('/') for path in selected}
+
+    # Flattened path trie: folder -> [files, selected files, bytes]
+    folders = {}
+    file_sizes = {}
+
+    for path, size in files:
+        path = path.strip('/')
+        parents = ancestors(path)
+        covered = path in selected or any(parent in selected for parent in parents)
+
+        if path in selected:
+            file_sizes[path] = size
+
+        for parent in parents:
+            entry = folders.setdefault(parent, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += covered
+            entry[2] += size or 0
+
+    def complete(folder):
+        entry = folders.get(folder)
+        return entry is not None and entry[0] == entry[1]
+
+    targets = {}
+
+    for path in selected:
+        parents = ancestors(path)
+        targets.setdefault(parents[-1] if parents and complete(parents[-1]) else path, []).append(path)
+
+    plan = []
+
+    # Parents sort before their children, a target inside another one joins its members
+    for path in sorted(targets):
+        outer = next((parent for parent in ancestors(path) if parent in targets), None)
+
+        if outer is not None:
+            targets[outer].extend(targets[path])
+        elif path in folders:
+            plan.append((path, 'folder', folders[path][0], folders[path][2], targets[path]))
+        else:
+            plan.append((path, 'file', 1, file_sizes.get(path, 0), targets[path]))
+
+    return plan
+
+
+def repo_files(conf, repo):
+    """
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :return generator: (path, size) of every file in the repo
+    """
+
+    aql_query = format_aql_query(f'items.find({{"repo":"{repo}","type":"file"}})')
+
+    for item in aql_stream(conf, aql_query, include=('size',)):
+        yield item_path(item), int(item.get('size') or 0)
+
+
+def plan_purge(conf, repo, paths):
+    """
+    Plans the deletes of the paths with `plan_deletes` and prints the plan
+
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param paths: list, File or folder paths to delete
+    :return list: The planned deletes
+    """
+
+    plan = plan_deletes(paths, repo_files(conf, repo))
+
+    table = Table("Delete", "Operations", "Files", "Size(MB)", title=f"Purge plan({repo})")
+
+    for kind in ('folder', 'file'):
+        items = [item for item in plan if item[1] == kind]
+        table.add_row(
+            kind, str(len(items)), str(sum(item[2] for item in items)), f"{sum(item[3] for item in items) / 1024 / 1024:.1f}"
+        )
+
+    table.add_row(
+        "total", str(len(plan)), str(sum(item[2] for item in plan)), f"{sum(item[3] for item in plan) / 1024 / 1024:.1f}"
+    )
+    console.print(table)
+    logging.info(f"{len(plan)} deletes planned for {len(paths)} matched paths")
+
+    return plan
+
+
+# Seconds between progress log lines when stderr is not a terminal
+PROGRESS_INTERVAL = 10
+
+
+def count_files(conf, repo, path):
+    """
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param path: string, A folder within the repo
+    :return int: Number of files below the folder, None when it no longer exists
+    """
+
+    url = f"{server_url(conf)}/artifactory/api/storage/{repo}/{quote(path.strip('/'))}"
+    response = session(conf).get(url, params='list&deep=1&listFolders=0')
+
+    if response.status_code == 404:
+        return None
+
+    response.raise_for_status()
+    return len(response.json().get('files', []))
+
+
+def delete_planned(conf, repo, operation):
+    """
+    Runs one delete of a `plan_deletes` plan. A folder is first listed again,
+    when it no longer holds the planned number of files (eg: something was
+    uploaded since the plan was made) only the selected paths are deleted.
+
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param operation: tuple, A planned delete
+    :return string: deleted, or missing when nothing was left to delete
+    """
+
+    path, kind, files, _, members = operation
+
+    if kind == 'file':
+        return delete_path(conf, repo, path)
+
+    current = count_files(conf, repo, path)
+
+    if current is None:
+        return 'missing'
+
+    if current != files:
+        logging.warning(f"{repo}:{path} holds {current} files instead of {files}, deleting the matched paths only")
+        statuses = [delete_path(conf, repo, member) for member in members]
+        return 'deleted' if 'deleted' in statuses else 'missing'
+
+    return delete_path(conf, repo, path)
+
+
+def delete_path(conf, repo, path):
+    """
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param path: string, Artifact or folder path within the repo
+    :return string: deleted, or missing when the path no longer exists
+    """
+
+    response = session(conf).delete(f"{server_url(conf)}/artifactory/{repo}/{quote(path.strip('/'))}")
+
+    if response.status_code == 404:
+        return 'missing'
+
+    response.raise_for_status()
+    return 'deleted'
+
+
+def purge_paths(conf, repo, paths, threads=5, total=None, audit=None, state=None, delete=None):
+    """
+    Deletes artifacts on the shared scheduler and waits for every delete to
+    finish. Progress and throughput are shown while deleting (logged every
+    PROGRESS_INTERVAL seconds when stderr is not a terminal) and a summary
+    table is printed at the end.
+
+    :param conf: dict, The artifactory config
+    :param repo: string, The artifactory repository
+    :param paths: iterable, Artifact paths within the repo, may be a generator
+    :param threads: int, Max deletes in flight, the shared worker pool grows to match
+    :param total: int, Number of paths when known up front
+    :param audit: string, Write the outcome of every delete to this ndjson file
+    :param state: dict, Kept up to date with the submitted and finished counts while deleting
+    :param delete: callable, Deletes one path and returns its status, defaults to `delete_path`
+    :return dict: Number of deleted, missing and failed paths and the elapsed seconds
+    """
+
+    summary = {'deleted': 0, 'missing': 0, 'failed': 0}
+    state = {} if state is None else state
+    state.update(summary, submitted=0)
+    start = time.perf_counter()
+    logged = start
+
+    err_console = Console(file=sys.stderr)
+    progress = Progress(
+        TextColumn(f"Purging {repo}"),
+        BarColumn(),
+        TextColumn("{task.completed}/{task.total}"),
+        TextColumn("{task.fields[rate]:>9.1f}/s"),
+        TimeRemainingColumn(),
+        console=err_console,
+        transient=True,
+    )
+    interactive = err_console.is_terminal
+    progress_task = progress.add_task(repo, total=total or 0, rate=0.0)
+
+    def counted(items):
+        for item in items:
+            state['submitted'] += 1
+            yield item
+
+    with open(audit, 'w') if audit else nullcontext() as audit_fh:
+        if interactive:
+            progress.start()
+
+        try:
+            results = scheduler.scheduler().run(
+                delete or (lambda path: delete_path(conf, repo, path)), counted(paths), limit=int(threads)
+            )
+
+            for path, status, error in results:
+                if error is not None:
+                    status = 'failed'
+                    logging.error(f"Failed to delete {repo}:{path}: {error}")
+                else:
+                    logging.debug(f"{status.capitalize()}: {repo}:{path}")
+
+                summary[status] += 1
+                state[status] += 1
+                metrics.count(f"artifacts_{status}")
+
+                if audit_fh:
+                    audit_fh.write(json.dumps({'path': path, 'status': status, 'error': error and str(error)}) + '\n')
+
+                done = sum(summary.values())
+                now = time.perf_counter()
+                rate = done / max(now - start, 1e-6)
+
+                if interactive:
+                    progress.update(progress_task, completed=done, total=max(total or 0, state['submitted']), rate=rate)
+                elif now - logged >= PROGRESS_INTERVAL:
+                    logged = now
+                    logging.info(f"Purged {done}/{total or state['submitted']} of {repo} ({rate:.1f}/s)")
+        finally:
+            progress.stop()
+
+    done = sum(summary.values())
+    summary['seconds'] = time.perf_counter() - start
+
+    table = Table("Repo", "Deleted", "Missing", "Failed", "Seconds", "Per second", title="Purge")
+    table.add_row(
+        repo, str(summary['deleted']), str(summary['missing']), str(summary['failed']),
+        f"{summary['seconds']:.1f}", f"{done / max(summary['seconds'], 1e-6):.1f}"
+    )
+    console.print(table)
+
+    return summary
 
 
 def format_aql_query(template):
@@ -1,12 +1,12 @@
 
 import json
-import requests
 
 from datetime import datetime
 from invoke import task, config, call
 from rich.table import Table
 from rich.console import Console
 
+from gadget import transport
 from gadget.tasks import init
 
 from azure.graphrbac import GraphRbacManagementClient
@@ -103,7 +103,9 @@ def add_user(ctx):
         'Content-Type': 'application/json'
     }
 
-    r = requests.post(
+    s = transport.session()
+
+    r = s.post(
         'https://graph.microsoft.com/v1.0/invitations', 
         headers=my_headers,
         json=json.dumps(params)
@@ -111,9 +113,7 @@ def add_user(ctx):
 
     print(json.dumps(r.json(), indent=2))
 
-    from requests import Request, Session
-
-    s = Session()
+    from requests import Request
 
     req = Request('POST', 'https://graph.microsoft.com/v1.0/invitations', json=json.dumps(params), headers=my_headers)
     prepped = req.prepare()
@@ -1,22 +1,25 @@
 
+from gadget import gitignore, httpcache, metrics, mirrors, scheduler, transport
 from gadget.tasks import init, utils
 from datetime import datetime
 from invoke import task, call
 from atlassian import Bitbucket
 from rich.console import Console
 from rich.table import Table
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 from contextlib import closing
 from datetime import timezone
 
 import requests
 import logging
 import json
+import csv
+import fnmatch
 import sqlite3
-import tempfile
 import os
 import re
 import sys
+import time
 
 console = Console()
 
@@ -97,18 +100,120 @@ def profiles(profile):
         sys.exit(1)
 
 
+def iter_pages(ctx, path, params=None, pagelen=100, cache=True, concurrent=True):
+    """
+    Yields the values of a Bitbucket 2.0 listing as the pages arrive. The
+    first response tells the collection size and page length, the remaining
+    pages are then fetched concurrently on the shared scheduler and yielded in
+    page order. Listings without a size fall back to following `next`.
+
+    :param path: string, The api path (eg: /2.0/repositories/{workspace})
+    :param params: dict, Query parameters for every page
+    :param pagelen: int, Requested page length, Bitbucket caps it at 100
+    :param cache: bool, Read the pages through the http cache
+    :param concurrent: bool, Fetch pages on the scheduler, must be off when already running on it
+    :return generator: The `values` of every page
+    """
+
+    bb = ctx.run_state.bb
+    params = dict(params or {}, pagelen=pagelen)
+
+    def get(**kwargs):
+        if not cache:
+            return bb.get(**kwargs)
+
+        with httpcache.policy():
+            return bb.get(**kwargs)
+
+    data = get(path=path, params=params)
+    yield from data['values']
+
+    if 'next' not in data:
+        return
+
+    if 'size' not in data or not concurrent:
+        while data.get('next'):
+            u = urlparse(data['next'])
+            logging.info(f"Fetching results page: {data.get('page')}")
+            data = get(path=f"{u.path}?{u.query}")
+            yield from data['values']
+
+        return
+
+    pages = -(-data['size'] // data['pagelen'])
+    logging.info(f"Fetching {pages - 1} more pages of {path}")
+
+    def fetch(page):
+        return get(path=path, params=dict(params, page=page))['values']
+
+    # Pages finish out of order, hold the early ones until their turn
+    fetched = {}
+    expected = data.get('page', 1) + 1
+
+    for page, values, error in scheduler.scheduler().run(fetch, range(expected, pages + 1)):
+        if error is not None:
+            raise error
+
+        fetched[page] = values
+
+        while expected in fetched:
+            yield from fetched.pop(expected)
+            expected += 1
+
+
+def iter_repos(ctx, workspace, project=None, repos=None):
+    """
+    :param workspace: string, The workspace slug
+    :param project: string, Only repos of this project key
+    :param repos: string, Only repos whose name contains this value
+    :return generator: The repositories of the workspace
+    """
+
+    query = {'role': 'member', 'sort': 'name'}
+
+    if project:
+        query.update({'q': f'project.key="{project}"'})
+    if repos:
+        query.update({'q': f'name~"{repos}"'})
+
+    return iter_pages(ctx, f"/2.0/repositories/{workspace}", params=query)
+
+
+def iter_branches(ctx, workspace, repo):
+    return iter_pages(ctx, f"/2.0/repositories/{workspace}/{repo}/refs/branches")
+
+
+def iter_users(ctx, workspace):
+    return iter_pages(ctx, f"/2.0/workspaces/{workspace}/permissions")
+
+
+def iter_permissions(ctx, workspace):
+    return iter_pages(ctx, f"/2.0/workspaces/{workspace}/permissions/repositories", params={'sort': 'user.nickname'})
+
+
 @task(pre=[init.load_conf])
 def init(ctx):
-    client = Bitbucket(
-        url='https://api.bitbucket.org',
-        username=ctx.config.main.bitbucket.username,
-        password=ctx.config.main.bitbucket.password,
-        cloud=True,
-        api_root='',
-        api_version='2.0'
-    )
+    username = ctx.config.main.bitbucket.username
+    password = ctx.config.main.bitbucket.password
+    url = ctx.config.main.bitbucket.get('url', 'https://api.bitbucket.org')
+
+    def connect():
+        session = transport.session()
+        client = Bitbucket(
+            url=url,
+            username=username,
+            password=password,
+            cloud=True,
+            api_root='',
+            api_version='2.0',
+            session=session
+        )
+        return client, session
+
+    client, session = utils.client_cache(('bitbucket', url, username, password), connect)
 
     ctx.run_state.bb = client
+    ctx.run_state.bb_session = session
     return client
 
 
@@ -127,62 +232,45 @@ def get_repo(ctx, repo):
 
 
 @task(pre=[init])
-def list_repos(ctx, workspace, project=None, repos=None, output=True):
+def list_repos(ctx, workspace, project=None, repos=None, output=True, ndjson=False):
     # workspace, _repo = repo_check(repo)
-    url_path = f"/2.0/repositories/{workspace}"
-    results = list()
-    has_next = False
-    query = {'role': 'member', 'sort': 'name', 'limit': 1000}
-
-    if project:
-        query.update({'q': f'project.key="{project}"'})
-    if repos:
-        query.update({'q': f'name~"{repos}"'})
+    rows = list()
 
     try:
-        data = ctx.run_state.bb.get(path=url_path, params=query)
-        results.extend(data['values'])
-
-        if 'next' in data.keys():
-            has_next = True
-
-        while has_next:
-            u = urlparse(data['next'])
-            logging.info(f"Fetching results page: {data['page']}")
-
-            url_path = f"{u.path}?{u.query}"
-            data = ctx.run_state.bb.get(path=url_path)
-            results.extend(data['values'])
+        if ndjson:
+            utils.write_ndjson(iter_repos(ctx, workspace, project=project, repos=repos))
+            return
 
-            has_next = data.get('next')
+        if not output:
+            return list(iter_repos(ctx, workspace, project=project, repos=repos))
 
-        # console.print(data)
+        rows = [
+            (
+                item['name'],
+                item['project']['key'],
+                item['language'],
+                datetime.strftime(datetime.fromisoformat(item['created_on']), '%b %m %Y'),
+            )
+            for item in iter_repos(ctx, workspace, project=project, repos=repos)
+        ]
     except requests.exceptions.HTTPError as e:
         logging.error(e)
 
-    if output:
-        table = Table(
-            "Name",
-            "Project",
-            "Language",
-            "Created",
-            title=f"Repositories({len(results)})"
-        )
+        if not output:
+            return []
 
-        for item in results:
-            create_time = datetime.fromisoformat(item['created_on'])
-            from datetime import timezone
+    table = Table(
+        "Name",
+        "Project",
+        "Language",
+        "Created",
+        title=f"Repositories({len(rows)})"
+    )
 
-            table.add_row(
-                item['name'],
-                item['project']['key'],
-                item['language'],
-                datetime.strftime(create_time, '%b %m %Y'),
-            )
+    for row in rows:
+        table.add_row(*row)
 
-        console.print(table)
-    else:
-        return results
+    console.print(table)
 
 
 @task(pre=[init])
@@ -192,21 +280,16 @@ def add_branches(ctx, repo, init=False):
 
     console.print(clone_url)
 
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        console.print('Created temporary directory', tmpdirname)
-        os.chdir(tmpdirname)
-        console.print(os.path.abspath(os.curdir))
+    workspace, slug = repo['full_name'].split('/')
 
-        try:
-            ctx.run(f"git clone {clone_url} .")
+    try:
+        with mirrors.checkout(clone_url, workspace, slug) as path, ctx.cd(path):
             ctx.run("git checkout -b master")
-            url = f"https://gitignore.io/api/{lang_code}"
-            r = requests.get(url)
 
-            with open('.gitignore', 'wb') as fh:
-                fh.write(r.content)
+            with open(os.path.join(path, '.gitignore'), 'wb') as fh:
+                fh.write(gitignore.template(lang_code))
 
-            with open('Jenkinsfile', 'w') as fh:
+            with open(os.path.join(path, 'Jenkinsfile'), 'w') as fh:
                 fh.write("PLZPipeline {}\n")
 
             ctx.run(f"git add .")
@@ -214,8 +297,8 @@ def add_branches(ctx, repo, init=False):
             ctx.run('git checkout -b develop')
             ctx.run('git push --all origin')
 
-        except Exception as e:
-            console.print(e)
+    except Exception as e:
+        console.print(e)
 
 
 @task(pre=[init])
@@ -225,35 +308,177 @@ def list_restrictions(ctx, repo):
     console.print(data)
 
 
+# Branch restrictions enforced on every repo by add_branch_checks / reconcile_branch_checks
+BRANCH_CHECKS = [
+    {'kind': 'require_approvals_to_merge', 'value': 1},
+    {'kind': 'require_passing_builds_to_merge', 'value': 1},
+    {'kind': 'require_tasks_to_be_completed'},
+    {'kind': 'push', 'groups': [{'name': 'Administrators', 'slug': 'Administrators'}]},
+    {'kind': 'force'},
+    {'kind': 'delete'}
+]
+
+CHECKED_BRANCHES = ['master', 'develop']
+
+
+def restriction_state(restriction):
+    """
+    :param restriction: dict, A desired check or an existing branch restriction
+    :return tuple: The parts compared when reconciling (value, group slugs, user uuids)
+    """
+
+    return (
+        restriction.get('value'),
+        tuple(sorted(group['slug'] for group in restriction.get('groups') or [])),
+        tuple(sorted(user['uuid'] for user in restriction.get('users') or [])),
+    )
+
+
+def plan_restrictions(existing, checks=None, branches=None, prune=False):
+    """
+    Diffs the existing branch restrictions of a repo against the desired checks
+
+    :param existing: list, The repo branch restrictions
+    :param checks: list, The desired checks, defaults to BRANCH_CHECKS
+    :param branches: list, The branch patterns to check, defaults to CHECKED_BRANCHES
+    :param prune: bool, Also delete restrictions that are not desired
+    :return list: (action, payload or restriction) tuples, actions are create, update and delete
+    """
+
+    desired = {
+        (check['kind'], branch): dict(check, branch_match_kind='glob', pattern=branch)
+        for branch in branches or CHECKED_BRANCHES for check in checks or BRANCH_CHECKS
+    }
+
+    actions = []
+    seen = set()
+
+    for restriction in sorted(existing, key=lambda i: i['id']):
+        key = (restriction['kind'], restriction.get('pattern'))
+
+        if key not in desired:
+            if prune:
+                actions.append(('delete', restriction))
+        elif key in seen:
+            # Duplicates left by earlier runs of add_branch_checks
+            actions.append(('delete', restriction))
+        else:
+            seen.add(key)
+
+            if restriction_state(restriction) != restriction_state(desired[key]):
+                actions.append(('update', dict(desired[key], id=restriction['id'])))
+
+    actions.extend(('create', payload) for key, payload in desired.items() if key not in seen)
+    return actions
+
+
 @task(pre=[init])
-def add_branch_checks(ctx, repo, init=False):
-    workspace, _repo = repo_check(repo)
+def reconcile_branch_checks(ctx, workspace, project=None, repos=None, prune=False, dry_run=False):
+    """ Enforce the branch checks on one repo or on every matching repo of a workspace
+    Parameter
+    ================
+    workspace: workspace/repo, or workspace/* for every repo matching project/repos
+    project: Only repos of this project key
+    repos: Only repos whose name contains this value
+    prune: Also delete branch restrictions that are not part of the checks
+    dry_run: Print the changes without applying them
+
+    The existing restrictions are read first and only missing, different or
+    duplicated restrictions are changed, so the task is safe to re-run.
+    """
 
-    checks = [
-        {'kind': 'require_approvals_to_merge', 'value': 1},
-        {'kind': 'require_passing_builds_to_merge', 'value': 1},
-        {'kind': 'require_tasks_to_be_completed'},
-        {'kind': 'push', 'groups': [{'name': 'Administrators', 'slug': 'Administrators'}]},
-        {'kind': 'force'},
-        {'kind': 'delete'}
-    ]
+    _workspace, _repo = repo_check(workspace)
+
+    if _repo == '*':
+        repo_list = [repo['slug'] for repo in list_repos(ctx, _workspace, project=project, repos=repos, output=False)]
+    else:
+        repo_list = [_repo]
 
-    branches = ['master', 'develop']
+    logging.info(f"Reconciling the branch checks of {len(repo_list)} repositories")
 
-    for branch in branches:
-        for check in checks:
-            try:
-                data = ctx.run_state.bb.add_branch_restriction(
-                    workspace, _repo, check['kind'],
-                    branch_match_kind='glob',
-                    branch_pattern=branch,
-                    value=check.get('value'),
-                    groups=check.get('groups'),
-                )
-                logging.debug(data)
-                logging.info(f"Successfully applied check of kind: {check.get('kind')}")
-            except requests.exceptions.HTTPError as e:
-                logging.error(f"{e.response.status_code}: {e.response.text}")
+    session = ctx.run_state.bb_session
+    base_url = ctx.run_state.bb.url
+    failed = 0
+
+    def plan(slug):
+        existing = iter_pages(
+            ctx, f"/2.0/repositories/{_workspace}/{slug}/branch-restrictions", cache=False, concurrent=False
+        )
+        return plan_restrictions(list(existing), prune=prune)
+
+    work = []
+
+    for slug, actions, error in scheduler.scheduler().run(plan, repo_list):
+        if error is not None:
+            failed += 1
+            logging.error(f"Unable to read the branch restrictions of {slug}: {error}")
+            continue
+
+        work.extend((slug, action, payload) for action, payload in actions)
+
+    logging.info(f"{len(work)} branch restrictions to change")
+
+    if dry_run:
+        table = Table("Repo", "Action", "Kind", "Branch", "Value", title=f"Branch checks({len(work)})")
+
+        for slug, action, payload in work:
+            table.add_row(slug, action, payload['kind'], payload.get('pattern'), str(payload.get('value') or ""))
+
+        console.print(table)
+        return work
+
+    def apply(item):
+        slug, action, payload = item
+        url = f"{base_url}/2.0/repositories/{_workspace}/{slug}/branch-restrictions"
+        body = {key: value for key, value in payload.items() if key not in ('id', 'links') and value is not None}
+
+        if action == 'create':
+            response = session.post(url, json=body)
+        elif action == 'update':
+            response = session.put(f"{url}/{payload['id']}", json=body)
+        else:
+            response = session.delete(f"{url}/{payload['id']}")
+
+        response.raise_for_status()
+
+    summary = {slug: {'create': 0, 'update': 0, 'delete': 0, 'failed': 0} for slug in repo_list}
+
+    for (slug, action, payload), _, error in scheduler.scheduler().run(apply, work):
+        if error is not None:
+            failed += 1
+            summary[slug]['failed'] += 1
+            logging.error(f"Unable to {action} {payload['kind']} on {slug}:{payload.get('pattern')}: {error}")
+            continue
+
+        summary[slug][action] += 1
+        metrics.count(f"restrictions_{action}d")
+
+    table = Table("Repo", "Created", "Updated", "Deleted", "Failed", title=f"Branch checks({len(repo_list)})")
+
+    for slug, counts in summary.items():
+        if any(counts.values()) or len(summary) <= 50:
+            table.add_row(slug, *[str(counts[key]) for key in ('create', 'update', 'delete', 'failed')])
+
+    console.print(table)
+
+    if failed:
+        sys.exit(1)
+
+    return work
+
+
+@task(pre=[init])
+def add_branch_checks(ctx, repo, init=False):
+    """ Reconcile the branch checks of a repo (see reconcile-branch-checks)
+    Parameter
+    ================
+    repo: workspace/repo
+
+    Missing checks are created, checks with a different value or groups are
+    updated and duplicated checks are deleted. Other restrictions are kept.
+    """
+
+    return reconcile_branch_checks(ctx, repo)
 
 
 @task(pre=[init])
@@ -390,41 +615,30 @@ def get_members(ctx, workspace):
 
 
 @task(pre=[init])
-def get_branches(ctx, repo, output=True):
+def get_branches(ctx, repo, output=True, ndjson=False):
     workspace, _repo = repo_check(repo)
     # data = ctx.run_state.bb.get_branches(workspace, _repo, filter='', limit=99999, details=True)
-    data = ctx.run_state.bb.get(path=f"/2.0/repositories/{workspace}/{_repo}/refs/branches")
-
-    table = Table(
-        "Branch",
-        "Author",
-        "Created",
-        title="Branches"
-    )
-
-    table.add_column("Age(Days)", justify="right")
+    results = list()
 
     try:
-        results = data['values']
-
-        if 'next' in data.keys():
-            has_next = True
-
-        while has_next:
-            u = urlparse(data['next'])
-            logging.info(f"Fetching results page: {data['page']}")
-
-            url_path = f"{u.path}?{u.query}"
-            data = ctx.run_state.bb.get(path=url_path)
-            results.extend(data['values'])
-
-            has_next = data.get('next')
-
-        # console.print(data)
+        if ndjson:
+            utils.write_ndjson(iter_branches(ctx, workspace, _repo))
+            return
+        else:
+            results = list(iter_branches(ctx, workspace, _repo))
     except requests.exceptions.HTTPError as e:
         logging.error(e)
 
     if output:
+        table = Table(
+            "Branch",
+            "Author",
+            "Created",
+            title="Branches"
+        )
+
+        table.add_column("Age(Days)", justify="right")
+
         for item in sorted(results, key=lambda i: i['target']['date']):
             create_time = datetime.fromisoformat(item['target']['date'])
             now = datetime.now(timezone.utc)
@@ -443,36 +657,126 @@ def get_branches(ctx, repo, output=True):
     return results
 
 
+def stale_branches(branches, age, keep=(), now=None):
+    """
+    :param branches: iterable, Branches from the refs/branches listing
+    :param age: int, Days since the last commit after which a branch is stale
+    :param keep: iterable, Glob patterns of branches that are never stale
+    :param now: datetime, Defaults to the current time
+    :return list: (branch, age in days) of the stale branches, oldest first
+    """
+
+    now = now or datetime.now(timezone.utc)
+    results = []
+
+    for branch in branches:
+        if any(fnmatch.fnmatchcase(branch['name'], pattern) for pattern in keep):
+            continue
+
+        days = (now - datetime.fromisoformat(branch['target']['date'])).days
+
+        if days > int(age):
+            results.append((branch, days))
+
+    return sorted(results, key=lambda i: i[1], reverse=True)
+
+
 @task(pre=[init])
-def delete_branches(ctx, repo, age):
-    workspace, _repo = repo_check(repo)
+def prune_branches(ctx, workspace, age, project=None, repos=None, keep="master,main,develop,release/*", dry_run=False):
+    """ Delete stale branches of one repo or of every matching repo of a workspace
+    Parameter
+    ================
+    workspace: workspace/repo, or workspace/* for every repo matching project/repos
+    age: Days since the last commit after which a branch is deleted
+    project: Only repos of this project key
+    repos: Only repos whose name contains this value
+    keep: Comma separated glob patterns of branches to keep, the main branch is always kept
+    dry_run: Print the stale branches without deleting them
+
+    Branches are picked from the refs/branches metadata and deleted through
+    the api, repos are processed concurrently and nothing is cloned.
+    """
 
-    repo_data = get_repo(ctx, repo)
-    clone_url = [item for item in repo_data['links']['clone'] if item['name'] == 'ssh'][0].get('href')
-    console.print(clone_url)
+    _workspace, _repo = repo_check(workspace)
+    patterns = [pattern.strip() for pattern in keep.split(',') if pattern.strip()]
 
-    branches = get_branches(ctx, repo, output=False)
+    if _repo == '*':
+        repo_list = list_repos(ctx, _workspace, project=project, repos=repos, output=False)
+    else:
+        repo_list = [ctx.run_state.bb.get(path=f"/2.0/repositories/{_workspace}/{_repo}")]
 
-    with tempfile.TemporaryDirectory() as tmpdirname:
-        console.print('Created temporary directory', tmpdirname)
-        os.chdir(tmpdirname)
-        console.print(os.path.abspath(os.curdir))
+    logging.info(f"Checking the branches of {len(repo_list)} repositories")
 
-        try:
-            ctx.run(f"git clone {clone_url} .")
+    def find(repo):
+        main_branch = (repo.get('mainbranch') or {}).get('name')
+        branches = iter_pages(
+            ctx, f"/2.0/repositories/{_workspace}/{repo['slug']}/refs/branches", cache=False, concurrent=False
+        )
+        return stale_branches(branches, age, keep=patterns + ([main_branch] if main_branch else []))
 
-            for branch in sorted(branches, key=lambda i: i['target']['date']):
-                create_time = datetime.fromisoformat(branch['target']['date'])
+    work = []
+    failed = 0
 
-                now = datetime.now(timezone.utc)
-                time_difference = create_time - now
+    for repo, stale, error in scheduler.scheduler().run(find, repo_list):
+        if error is not None:
+            failed += 1
+            logging.error(f"Unable to list the branches of {repo['full_name']}: {error}")
+            continue
 
-                if -(int(time_difference.days)) > int(age):
-                    logging.info(f"Deleting branch: {branch['name']} of age: {-(time_difference.days)}")
-                    ctx.run(f"git push origin --delete {branch['name']}")
+        work.extend((repo['slug'], branch, days) for branch, days in stale)
 
-        except Exception as e:
-            console.print(e)
+    if dry_run:
+        table = Table("Repo", "Branch", "Author", "Age(Days)", title=f"Stale branches({len(work)})")
+
+        for slug, branch, days in work:
+            table.add_row(slug, branch['name'], branch['target']['author']['raw'], str(days))
+
+        console.print(table)
+        return work
+
+    session = ctx.run_state.bb_session
+    base_url = ctx.run_state.bb.url
+
+    def delete(item):
+        slug, branch, days = item
+        response = session.delete(
+            f"{base_url}/2.0/repositories/{_workspace}/{slug}/refs/branches/{quote(branch['name'], safe='')}"
+        )
+        response.raise_for_status()
+
+    summary = {}
+
+    for (slug, branch, days), _, error in scheduler.scheduler().run(delete, work):
+        counts = summary.setdefault(slug, {'deleted': 0, 'failed': 0})
+
+        if error is not None:
+            failed += 1
+            counts['failed'] += 1
+            logging.error(f"Unable to delete {slug}:{branch['name']}: {error}")
+        else:
+            counts['deleted'] += 1
+            metrics.count('branches_deleted')
+            logging.debug(f"Deleted branch {slug}:{branch['name']} of age {days}")
+
+    table = Table("Repo", "Deleted", "Failed", title=f"Pruned branches({len(work)})")
+
+    for slug, counts in sorted(summary.items()):
+        table.add_row(slug, str(counts['deleted']), str(counts['failed']))
+
+    console.print(table)
+
+    if failed:
+        sys.exit(1)
+
+    return work
+
+
+@task(pre=[init])
+def delete_branches(ctx, repo, age, dry_run=False):
+    """ Delete the branches of a repo whose last commit is older than age days
+    """
+
+    return prune_branches(ctx, repo, age, dry_run=dry_run)
 
 
 @task(pre=[init])
@@ -487,28 +791,18 @@ def list_projects(ctx, workspace):
 
 
 @task(pre=[init])
-def get_users(ctx, workspace):
-
-    data = ctx.run_state.bb.get(f"/2.0/workspaces/{workspace}/permissions")
-    console.print(data['values'][0])
+def get_users(ctx, workspace, ndjson=False):
+    rows = list()
 
     try:
-        results = data['values']
-
-        if 'next' in data.keys():
-            has_next = True
-
-        while has_next:
-            u = urlparse(data['next'])
-            logging.info(f"Fetching results page: {data['page']}")
-
-            url_path = f"{u.path}?{u.query}"
-            data = ctx.run_state.bb.get(path=url_path)
-            results.extend(data['values'])
-
-            has_next = data.get('next')
-
-        # console.print(data)
+        if ndjson:
+            utils.write_ndjson(iter_users(ctx, workspace))
+            return
+
+        rows = [
+            (item['user']['display_name'], item['user']['nickname'], item['permission'])
+            for item in iter_users(ctx, workspace)
+        ]
     except requests.exceptions.HTTPError as e:
         logging.error(e)
 
@@ -517,23 +811,133 @@ def get_users(ctx, workspace):
         "NickName",
         "Permission",
         "Created",
-        title=f"Repositories({data['size']})"
+        title=f"Repositories({len(rows)})"
     )
 
-    for item in sorted(results, key=lambda i: i['user']['display_name']):
+    for row in sorted(rows):
         # create_time = datetime.fromisoformat(item['added_on'])
-        from datetime import timezone
-
-        table.add_row(
-            item['user']['display_name'],
-            item['user']['nickname'],
-            item['permission'],
-            # datetime.strftime(create_time, '%b %m %Y'),
-        )
+        table.add_row(*row)
 
     console.print(table)
 
 
+#
+# Permissions database, filled by load_permissions and sync_permissions
+#
+DB_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS user (
+        uuid TEXT,
+        display_name TEXT,
+        nickname TEXT,
+        account_id TEXT
+    );
+    """,
+
+    """
+    CREATE TABLE IF NOT EXISTS repo (
+        uuid TEXT,
+        name TEXT,
+        full_name TEXT,
+        updated_on TEXT
+    );
+    """,
+
+    """
+    CREATE TABLE IF NOT EXISTS permission (
+        user_id TEXT,
+        repo_id TEXT,
+        permission TEXT
+    );
+    """,
+
+    """
+    CREATE TABLE IF NOT EXISTS sync (
+        workspace TEXT PRIMARY KEY,
+        synced_at TEXT,
+        repos INTEGER,
+        skipped INTEGER
+    );
+    """
+]
+
+# (index, table, columns), unique indexes double as the upsert keys
+DB_UNIQUE_INDEXES = [
+    ('user_uuid', 'user', 'uuid'),
+    ('repo_uuid', 'repo', 'uuid'),
+    ('permission_user_repo', 'permission', 'user_id, repo_id'),
+]
+
+DB_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS permission_repo ON permission (repo_id);",
+    "CREATE INDEX IF NOT EXISTS repo_full_name ON repo (full_name);",
+    "CREATE INDEX IF NOT EXISTS repo_name ON repo (name);",
+    "CREATE INDEX IF NOT EXISTS user_nickname ON user (nickname);",
+    "CREATE INDEX IF NOT EXISTS user_display_name ON user (display_name);",
+]
+
+UPSERT_USER = """
+    INSERT INTO user (uuid, display_name, nickname, account_id) VALUES (?, ?, ?, ?)
+    ON CONFLICT (uuid) DO UPDATE SET
+        display_name = excluded.display_name, nickname = excluded.nickname, account_id = excluded.account_id
+"""
+
+UPSERT_REPO = """
+    INSERT INTO repo (uuid, name, full_name, updated_on) VALUES (?, ?, ?, ?)
+    ON CONFLICT (uuid) DO UPDATE SET
+        name = excluded.name, full_name = excluded.full_name,
+        updated_on = COALESCE(excluded.updated_on, repo.updated_on)
+"""
+
+UPSERT_PERMISSION = """
+    INSERT INTO permission (user_id, repo_id, permission) VALUES (?, ?, ?)
+    ON CONFLICT (user_id, repo_id) DO UPDATE SET permission = excluded.permission
+"""
+
+
+def connect_db(db="bitbucket.db"):
+    """
+    Opens the permissions db in WAL mode, creating or upgrading the schema.
+    Databases created before the unique keys existed are de-duplicated first.
+
+    :param db: string, Location of the sqlite db
+    :return Connection: The open connection
+    """
+
+    connection = sqlite3.connect(db)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+
+    with connection:
+        for q in DB_SCHEMA:
+            connection.execute(q)
+
+        if 'updated_on' not in {row[1] for row in connection.execute("PRAGMA table_info(repo)")}:
+            connection.execute("ALTER TABLE repo ADD COLUMN updated_on TEXT")
+
+        existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+        for name, table, columns in DB_UNIQUE_INDEXES:
+            if name not in existing:
+                connection.execute(
+                    f"DELETE FROM {table} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {table} GROUP BY {columns})"
+                )
+                connection.execute(f"CREATE UNIQUE INDEX {name} ON {table} ({columns})")
+
+        for q in DB_INDEXES:
+            connection.execute(q)
+
+    return connection
+
+
+def user_row(user):
+    return user['uuid'], user.get('display_name'), user.get('nickname'), user.get('account_id')
+
+
+def repo_row(repo, updated_on=None):
+    return repo['uuid'], repo['name'], repo['full_name'], updated_on or repo.get('updated_on')
+
+
 def init_db(ctx, db="bitbucket.db"):
     """
     Initializes a sqlite db for the permissions load:
@@ -543,96 +947,154 @@ def init_db(ctx, db="bitbucket.db"):
     :return:
     """
 
-    schema = [
-        """
-        CREATE TABLE user (
-            uuid TEXT,
-            display_name TEXT,
-            nickname TEXT,
-            account_id TEXT
-        );
-        """,
-
-        """
-        CREATE TABLE repo (
-            uuid TEXT,
-            name TEXT,
-            full_name TEXT
-        );
-        """,
+    connect_db(db).close()
 
-        """
-        CREATE TABLE permission (
-            user_id TEXT,
-            repo_id TEXT,
-            permission TEXT
-        );
-        """
-    ]
 
-    if not os.path.exists("bitbucket.db"):
-        connection = sqlite3.connect(db)
-        cursor = connection.cursor()
-        for q in schema:
-            cursor.execute(q)
+@task(pre=[init])
+def sync_permissions(ctx, workspace, db="bitbucket.db", full=False):
+    """ Incrementally sync the repository permissions of a workspace into sqlite
+    Parameter
+    ================
+    workspace: The workspace slug
+    db: Location of the sqlite db
+    full: Re-read every repo, not only the ones updated since the last sync
+
+    Users, repos and permissions are upserted on their uuid, permissions and
+    repos that no longer exist are removed and the sync time is recorded in
+    the `sync` table.
+    """
 
-        connection.commit()
-        connection.close()
+    connection = connect_db(db)
+    known = dict(connection.execute(
+        "SELECT uuid, updated_on FROM repo WHERE full_name LIKE ?", (f"{workspace}/%",)
+    ).fetchall())
 
+    query = {
+        'role': 'member',
+        'fields': 'size,page,pagelen,next,values.uuid,values.slug,values.name,values.full_name,values.updated_on',
+    }
 
-@task(pre=[init])
-def get_permissions(ctx, workspace, table=False):
-    data = ctx.run_state.bb.get(f"/2.0/workspaces/{workspace}/permissions/repositories?sort=user.nickname")
-    console.print(data['values'][0])
+    listed = {}
 
-    try:
-        results = data['values']
+    for repo in iter_pages(ctx, f"/2.0/repositories/{workspace}", params=query, cache=False):
+        listed[repo['uuid']] = repo
 
-        if 'next' in data.keys():
-            has_next = True
+    changed = [repo for uuid, repo in listed.items() if full or known.get(uuid) != repo.get('updated_on')]
+    logging.info(f"{len(changed)} of {len(listed)} repositories changed since the last sync")
 
-        while has_next:
-            u = urlparse(data['next'])
-            logging.info(f"Fetching results page: {data['page']}")
+    def fetch(repo):
+        path = f"/2.0/workspaces/{workspace}/permissions/repositories/{repo['slug']}"
+        return list(iter_pages(ctx, path, cache=False, concurrent=False))
 
-            url_path = f"{u.path}?{u.query}"
-            data = ctx.run_state.bb.get(path=url_path)
-            results.extend(data['values'])
+    counts = {'synced': 0, 'failed': 0, 'permissions': 0, 'removed_permissions': 0, 'removed_repos': 0}
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS seen (user_id TEXT)")
 
-            has_next = data.get('next')
+    for num, (repo, records, error) in enumerate(scheduler.scheduler().run(fetch, changed), start=1):
+        if error is not None:
+            counts['failed'] += 1
+            logging.error(f"Unable to read the permissions of {repo['full_name']}: {error}")
+            continue
 
-        # console.print(data)
-    except requests.exceptions.HTTPError as e:
-        logging.error(e)
+        connection.execute("DELETE FROM temp.seen")
+        connection.executemany(UPSERT_USER, {user_row(item['user']) for item in records})
+        connection.executemany(
+            UPSERT_PERMISSION, [(item['user']['uuid'], repo['uuid'], item['permission']) for item in records]
+        )
+        connection.executemany("INSERT INTO temp.seen VALUES (?)", [(item['user']['uuid'],) for item in records])
+        removed = connection.execute(
+            "DELETE FROM permission WHERE repo_id = ? AND user_id NOT IN (SELECT user_id FROM temp.seen)",
+            (repo['uuid'],)
+        ).rowcount
+        # Marks the repo as synced, only once its permissions are stored
+        connection.execute(UPSERT_REPO, repo_row(repo))
+
+        counts['synced'] += 1
+        counts['permissions'] += len(records)
+        counts['removed_permissions'] += removed
+
+        if num % 100 == 0:
+            connection.commit()
+            logging.info(f"Synced {num} of {len(changed)} repositories")
+
+    gone = [uuid for uuid in known if uuid not in listed]
+
+    with connection:
+        connection.executemany("DELETE FROM permission WHERE repo_id = ?", [(uuid,) for uuid in gone])
+        connection.executemany("DELETE FROM repo WHERE uuid = ?", [(uuid,) for uuid in gone])
+        connection.execute("DELETE FROM user WHERE uuid NOT IN (SELECT user_id FROM permission)")
+        connection.execute(
+            """
+            INSERT INTO sync (workspace, synced_at, repos, skipped) VALUES (?, ?, ?, ?)
+            ON CONFLICT (workspace) DO UPDATE SET
+                synced_at = excluded.synced_at, repos = excluded.repos, skipped = excluded.skipped
+            """,
+            (workspace, datetime.now(timezone.utc).isoformat(), len(listed), len(listed) - len(changed))
+        )
 
-    with open('results.json', 'w') as fh:
-        fh.write(json.dumps(results, indent=2))
+    connection.close()
+    counts['removed_repos'] = len(gone)
+    metrics.count('repos_synced', counts['synced'])
 
-    table = Table(
-        "DisplayName",
-        "NickName",
-        "Repository",
-        "Permission",
-        title=f"Permissions({data['size']})"
+    table = Table("Repos", "Synced", "Skipped", "Failed", "Permissions", "Removed", title=f"Sync({workspace})")
+    table.add_row(
+        str(len(listed)), str(counts['synced']), str(len(listed) - len(changed)), str(counts['failed']),
+        str(counts['permissions']), f"{counts['removed_permissions']} permissions, {counts['removed_repos']} repos"
     )
+    console.print(table)
 
-    # uuid = re.sub(r'{|}', '', data['user']['uuid'])
+    if counts['failed']:
+        sys.exit(1)
 
-    for item in results:
-        for item in sorted(results, key=lambda i: i['user']['display_name']):
-        # create_time = datetime.fromisoformat(item['added_on'])
-        # from datetime import timezone
-
-            if table:
-                table.add_row(
-                    item['user']['display_name'],
-                    item['user']['nickname'],
-                    item['repository']['full_name'],
-                    item['permission'],
-                    # datetime.strftime(create_time, '%b %m %Y'),
-                )
 
-    # console.print(table)
+@task(pre=[init])
+def get_permissions(ctx, workspace, table=False, output="results.ndjson", ndjson=False):
+    """ Export the explicit repository permissions of a workspace
+    Parameter
+    ================
+    workspace: The workspace slug
+    table: Print a table of the permissions
+    output: File the permissions are streamed to as newline delimited json
+    ndjson: Also stream the permissions to stdout as newline delimited json
+    """
+
+    rows = list()
+    count = 0
+
+    with open(output, 'w') as fh:
+        try:
+            for item in iter_permissions(ctx, workspace):
+                line = f"{json.dumps(item)}\n"
+                fh.write(line)
+                count += 1
+
+                if ndjson:
+                    sys.stdout.write(line)
+
+                if table:
+                    rows.append((
+                        item['user']['display_name'],
+                        item['user']['nickname'],
+                        item['repository']['full_name'],
+                        item['permission'],
+                    ))
+        except requests.exceptions.HTTPError as e:
+            logging.error(e)
+
+    logging.info(f"Wrote {count} permissions to {output}")
+
+    if table:
+        console_table = Table(
+            "DisplayName",
+            "NickName",
+            "Repository",
+            "Permission",
+            title=f"Permissions({count})"
+        )
+
+        for row in sorted(rows, key=lambda i: i[0]):
+            console_table.add_row(*row)
+
+        console.print(console_table)
 
 
 @task(pre=[init])
@@ -657,15 +1119,45 @@ def get_repo_groups(ctx, repo, table=False):
     console.print(table)
 
 
+def group_privileges(ctx, workspace, repo=None):
+    """
+    Reads the current group privileges in one request per workspace (or repo)
+
+    :param workspace: string, The workspace slug
+    :param repo: string, Limit to one repository
+    :return dict: Privilege keyed on (repo slug, group slug)
+    """
+
+    path = f"/1.0/group-privileges/{workspace}/{repo}" if repo else f"/1.0/group-privileges/{workspace}"
+    data = ctx.run_state.bb.get(path=path)
+
+    return {
+        (item['repo'].split('/')[-1], item['group']['slug']): item['privilege'] for item in data or []
+    }
+
+
 @task(pre=[init])
-def set_repo_groups(ctx, workspace, profile, project=None, repos=None):
+def set_repo_groups(ctx, workspace, profile, project=None, repos=None, dry_run=False):
+    """ Apply a group profile to one repo or to every matching repo of a workspace
+    Parameter
+    ================
+    workspace: workspace/repo, or workspace/* for every repo matching project/repos
+    profile: The group profile to apply (see `profiles`)
+    project: Only repos of this project key
+    repos: Only repos whose name contains this value
+    dry_run: Print the changes without applying them
+
+    The current privileges are read up front and only the groups that differ
+    from the profile are updated.
+    """
+
     _workspace, _repo = repo_check(workspace)
 
     if _repo == '*':
-        repo_list = list_repos(ctx, _workspace, project=project, repos=repos, output=False)
+        repo_list = [repo.get('slug', repo['name']) for repo in list_repos(ctx, _workspace, project=project, repos=repos, output=False)]
         logging.info(f"Processing {len(repo_list)} repositories")
     else:
-        repo_list = [dict(name=_repo)]
+        repo_list = [_repo]
 
     try:
         group_profile = profiles(profile)
@@ -674,32 +1166,69 @@ def set_repo_groups(ctx, workspace, profile, project=None, repos=None):
         logging.error(f"Invalid profile {profile} supplied")
         sys.exit(1)
 
-    for group,permission in group_profile.items():
-        headers = {
-            'Accept': 'application/json',
-            'Content-Type': "text/plain",
-        }
+    try:
+        current = group_privileges(ctx, _workspace, repo=None if _repo == '*' else _repo)
+    except requests.exceptions.HTTPError as e:
+        logging.warning(f"Unable to read the current group privileges, applying every group: {e}")
+        current = {}
 
-        if project or repos:
-            for repo in repo_list:
-                url = f"{ctx.run_state.bb.url}/1.0/group-privileges/{_workspace}/{repo['name']}/{_workspace}/{group}"
+    headers = {
+        'Accept': 'application/json',
+        'Content-Type': "text/plain",
+    }
 
-                try:
-                    response = requests.put(url, data=permission, headers=headers, auth=(ctx.run_state.bb.username, ctx.run_state.bb.password))
-                    logging.info(f"Repo: {repo['name']}\tGroup: {group}:{permission} -> {response.reason}")
-                except Exception:
-                    logging.error(f"Repo: {repo['name']}\tGroup: {group}:{permission} -> {response.reason} :: {response.text}")
-                    sys.exit(1)
-        else:
-            url = f"{ctx.run_state.bb.url}/1.0/group-privileges/{_workspace}/{_repo}/{_workspace}/{group}"
+    session = ctx.run_state.bb_session
+    base_url = ctx.run_state.bb.url
+
+    def put(item):
+        repo_name, group, permission = item
+        url = f"{base_url}/1.0/group-privileges/{_workspace}/{repo_name}/{_workspace}/{group}"
+        response = session.put(url, data=permission, headers=headers)
+        response.raise_for_status()
+        return response
 
-            try:
-                response = requests.put(url, data=permission, headers=headers,
-                                        auth=(ctx.run_state.bb.username, ctx.run_state.bb.password))
-                logging.info(f"Repo: {_repo}\tGroup: {group}:{permission} -> {response.reason}")
-            except Exception:
-                logging.error(f"Repo: {_repo}\tGroup: {group}:{permission} -> {response.reason} :: {response.text}")
-                sys.exit(1)
+    summary = {repo_name: {'unchanged': 0, 'updated': 0, 'failed': 0} for repo_name in repo_list}
+    work = []
+
+    for repo_name in repo_list:
+        for group, permission in group_profile.items():
+            if current.get((repo_name, group)) == permission:
+                summary[repo_name]['unchanged'] += 1
+            else:
+                work.append((repo_name, group, permission))
+
+    logging.info(f"{len(work)} group privileges to update, {len(repo_list) * len(group_profile) - len(work)} unchanged")
+
+    if dry_run:
+        for repo_name, group, permission in work:
+            console.print(f"Repo: {repo_name}\tGroup: {group}: {current.get((repo_name, group))} -> {permission}")
+        return
+
+    for (repo_name, group, permission), response, error in scheduler.scheduler().run(put, work):
+        if error is not None:
+            summary[repo_name]['failed'] += 1
+            metrics.count('permissions_failed')
+            logging.error(f"Repo: {repo_name}\tGroup: {group}:{permission} -> {error}")
+            continue
+
+        summary[repo_name]['updated'] += 1
+        metrics.count('permissions_updated')
+        logging.info(f"Repo: {repo_name}\tGroup: {group}:{permission} -> {response.reason}")
+
+    table = Table("Repo", "Unchanged", "Updated", "Failed", title=f"Group privileges({profile})")
+
+    for repo_name, counts in summary.items():
+        if counts['updated'] or counts['failed'] or len(summary) <= 50:
+            table.add_row(repo_name, str(counts['unchanged']), str(counts['updated']), str(counts['failed']))
+
+    table.add_row(
+        f"{len(summary)} repos",
+        *[str(sum(counts[key] for counts in summary.values())) for key in ('unchanged', 'updated', 'failed')]
+    )
+    console.print(table)
+
+    if any(counts['failed'] for counts in summary.values()):
+        sys.exit(1)
 
 
 @task(pre=[init])
@@ -720,8 +1249,7 @@ def set_repo_project(ctx, workspace, project, repos=None):
         url = f"{ctx.run_state.bb.url}/1.0/group-privileges/{workspace}/{_repo}/{workspace}/{group}"
 
         try:
-            response = requests.put(url, data=permission, headers=headers,
-                                    auth=(ctx.run_state.bb.username, ctx.run_state.bb.password))
+            response = ctx.run_state.bb_session.put(url, data=permission, headers=headers)
             logging.info(f"Repo: {_repo}\tGroup: {group}:{permission} -> {response.reason}")
         except Exception:
             logging.error(f"Repo: {_repo}\tGroup: {group}:{permission} -> {response.reason} :: {response.text}")
@@ -729,79 +1257,241 @@ def set_repo_project(ctx, workspace, project, repos=None):
 
 
 @task()
-def load_permissions(ctx, input="results.json", db="bitbucket.db"):
+def load_permissions(ctx, input="results.ndjson", db="bitbucket.db", batch=10000):
     """
-    Loads the permissions json output from get_permissons task:
+    Loads the permissions output from get_permissons task, newline delimited
+    or a json array, into the permissions db. Records are parsed one at a time
+    and upserted in batches, permissions of the loaded repos that are missing
+    from the input are removed in the same transaction:
 
-    :param input:
-    :param db:
+    :param input: string, The get_permissions output
+    :param db: string, Location of the sqlite db
+    :param batch: int, Records per write
 
-    :return:
+    :return int: Number of records loaded
     """
 
-    raw = json.load(open(input, 'r'))
-    logging.info(f"Loaded input file {input} with {len(raw)} records")
+    logging.info(f"Loading input file {input}")
+    start = time.perf_counter()
+    count = 0
+    connection = connect_db(db)
+    connection.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS seen (user_id TEXT, repo_id TEXT, PRIMARY KEY (user_id, repo_id))"
+    )
+    connection.execute("DELETE FROM temp.seen")
+
+    def flush(records):
+        users = {item['user']['uuid']: user_row(item['user']) for item in records}
+        repos = {item['repository']['uuid']: repo_row(item['repository']) for item in records}
+        permissions = [(item['user']['uuid'], item['repository']['uuid'], item['permission']) for item in records]
+
+        connection.executemany(UPSERT_USER, users.values())
+        connection.executemany(UPSERT_REPO, repos.values())
+        connection.executemany(UPSERT_PERMISSION, permissions)
+        connection.executemany(
+            "INSERT OR IGNORE INTO temp.seen VALUES (?, ?)", [(user, repo) for user, repo, _ in permissions]
+        )
 
-    with open('bitbucket_report.csv', 'w') as fh:
-        fh.write("Name,Repo,Permission\n")
+    # One transaction, a failed load leaves the db as it was
+    with connection, open('bitbucket_report.csv', 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["Name", "Repo", "Permission"])
         current_user = ""
+        records = []
+
+        for item in utils.read_records(input):
+            writer.writerow([
+                "" if current_user == item['user']['uuid'] else item['user']['display_name'],
+                item['repository']['full_name'],
+                item['permission'],
+            ])
+            current_user = item['user']['uuid']
 
-        for item in raw:
-            if current_user == item['user']['uuid']:
-                data = [
-                    "",
-                    item['repository']['full_name'],
-                    item['permission']
-                ]
-            else:
-                data = [
-                    item['user']['display_name'],
-                    item['repository']['full_name'],
-                    item['permission']
-                ]
+            records.append(item)
+            count += 1
 
-            fh.write(f"{','.join(data)}\n")
-            current_user = item['user']['uuid']
+            if len(records) >= int(batch):
+                flush(records)
+                records = []
+
+        if records:
+            flush(records)
 
-    with closing(sqlite3.connect(db)) as connection:
-        with closing(connection.cursor()) as cursor:
-            for item in raw:
-
-                # user_uuid = re.sub(r'{|}', '', item['user']['uuid'])
-
-                user = f"""
-                    INSERT INTO 
-                        user (uuid, display_name, nickname, account_id)
-                    VALUES(
-                        "{item['user']['uuid']}",
-                        "{item['user']['display_name']}",
-                        "{item['user']['nickname']}",
-                        "{item['user']['account_id']}"
-                    )
-                """
-                cursor.execute(user)
-
-                repo = f"""
-                    INSERT INTO 
-                        repo (uuid, name, full_name)
-                    VALUES(
-                        "{item['repository']['uuid']}",
-                        "{item['repository']['name']}",
-                        "{item['repository']['full_name']}"
-                    )
-                """
-                cursor.execute(repo)
-
-                perm = f"""
-                    INSERT INTO 
-                        permission (user_id, repo_id, permission)
-                    VALUES(
-                        "{item['user']['uuid']}",
-                        "{item['repository']['uuid']}",
-                        "{item['permission']}"
-                    )
-                """
-                cursor.execute(perm)
-
-        connection.commit()
+        removed = connection.execute(
+            """
+            DELETE FROM permission
+            WHERE repo_id IN (SELECT repo_id FROM temp.seen)
+            AND NOT EXISTS (
+                SELECT 1 FROM temp.seen s WHERE s.user_id = permission.user_id AND s.repo_id = permission.repo_id
+            )
+            """
+        ).rowcount
+
+    connection.close()
+    metrics.count('permissions_loaded', count)
+    metrics.count('permissions_removed', removed)
+    logging.info(
+        f"Loaded {count} records into {db} and removed {removed} stale permissions "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
 
+    return count
+
+
+PERMISSION_RANK = "CASE p.permission WHEN 'admin' THEN 3 WHEN 'write' THEN 2 WHEN 'read' THEN 1 ELSE 0 END"
+
+# Report name -> (columns, sql), the queries only read the permissions db
+REPORTS = {
+    'user-repos': (
+        ("User", "Repository", "Permission"),
+        """
+        SELECT u.display_name, r.full_name, p.permission
+        FROM permission p
+        JOIN user u ON u.uuid = p.user_id
+        JOIN repo r ON r.uuid = p.repo_id
+        WHERE p.user_id IN (
+            SELECT uuid FROM user WHERE nickname = :user
+            UNION SELECT uuid FROM user WHERE display_name = :user
+            UNION SELECT uuid FROM user WHERE uuid = :user
+        )
+        ORDER BY r.full_name
+        """
+    ),
+    'repo-users': (
+        ("Repository", "User", "NickName", "Permission"),
+        f"""
+        SELECT r.full_name, u.display_name, u.nickname, p.permission
+        FROM permission p
+        JOIN user u ON u.uuid = p.user_id
+        JOIN repo r ON r.uuid = p.repo_id
+        WHERE p.repo_id IN (
+            SELECT uuid FROM repo WHERE full_name = :repo
+            UNION SELECT uuid FROM repo WHERE name = :repo
+        )
+        ORDER BY {PERMISSION_RANK} DESC, u.display_name
+        """
+    ),
+    'effective': (
+        ("User", "NickName", "Effective", "Admin", "Write", "Read"),
+        f"""
+        SELECT
+            u.display_name, u.nickname,
+            CASE MAX({PERMISSION_RANK}) WHEN 3 THEN 'admin' WHEN 2 THEN 'write' WHEN 1 THEN 'read' ELSE 'none' END,
+            SUM(p.permission = 'admin'), SUM(p.permission = 'write'), SUM(p.permission = 'read')
+        FROM permission p
+        JOIN user u ON u.uuid = p.user_id
+        WHERE :user IS NULL OR u.nickname = :user OR u.display_name = :user OR u.uuid = :user
+        GROUP BY u.uuid
+        ORDER BY MAX({PERMISSION_RANK}) DESC, u.display_name
+        """
+    ),
+    'diff': (
+        ("Change", "User", "Repository", "Before", "After"),
+        """
+        SELECT
+            CASE WHEN o.permission IS NULL THEN 'added' ELSE 'changed' END,
+            COALESCE(u.display_name, p.user_id), COALESCE(r.full_name, p.repo_id), o.permission, p.permission
+        FROM permission p
+        LEFT JOIN other.permission o ON o.user_id = p.user_id AND o.repo_id = p.repo_id
+        LEFT JOIN user u ON u.uuid = p.user_id
+        LEFT JOIN repo r ON r.uuid = p.repo_id
+        WHERE o.permission IS NULL OR o.permission != p.permission
+        UNION ALL
+        SELECT
+            'removed', COALESCE(u.display_name, o.user_id), COALESCE(r.full_name, o.repo_id), o.permission, NULL
+        FROM other.permission o
+        LEFT JOIN permission p ON p.user_id = o.user_id AND p.repo_id = o.repo_id
+        LEFT JOIN other.user u ON u.uuid = o.user_id
+        LEFT JOIN other.repo r ON r.uuid = o.repo_id
+        WHERE p.permission IS NULL
+        ORDER BY 3, 2
+        """
+    ),
+}
+
+# Report name -> the parameter the report can't run without
+REPORT_PARAMS = {
+    'user-repos': 'user',
+    'repo-users': 'repo',
+    'diff': 'against',
+}
+
+
+def run_report(db, name, user=None, repo=None, against=None):
+    """
+    :param db: string, Location of the permissions db
+    :param name: string, The report to run (see REPORTS)
+    :param user: string, User nickname, display name or uuid
+    :param repo: string, Repository full name or name
+    :param against: string, An older permissions db to diff against
+    :return tuple: (columns, rows)
+    """
+
+    required = REPORT_PARAMS.get(name)
+
+    if required and not {'user': user, 'repo': repo, 'against': against}[required]:
+        raise ValueError(f"The {name} report needs --{required}")
+
+    if not os.path.exists(db):
+        raise FileNotFoundError(f"No permissions db at {db}, run bitbucket.sync-permissions first")
+
+    columns, sql = REPORTS[name]
+
+    with closing(sqlite3.connect(f"file:{db}?mode=ro", uri=True)) as connection:
+        if name == 'diff':
+            if not against or not os.path.exists(against):
+                raise FileNotFoundError(f"The diff report needs --against with an existing db, got {against}")
+
+            connection.execute("ATTACH DATABASE ? AS other", (f"file:{against}?mode=ro",))
+
+        return columns, connection.execute(sql, {'user': user, 'repo': repo}).fetchall()
+
+
+@task()
+def report(ctx, name, db="bitbucket.db", user=None, repo=None, against=None, format="table", output=None):
+    """ Answer access questions offline from the permissions db
+    Parameter
+    ================
+    name: The report, one of user-repos (--user), repo-users (--repo), effective (optional --user), diff (--against)
+    db: Location of the permissions db (see sync-permissions / load-permissions)
+    user: User nickname, display name or uuid
+    repo: Repository full name (workspace/repo) or name
+    against: An older copy of the permissions db, the diff report lists what changed since
+    format: table, csv or json
+    output: Write csv or json to this file instead of stdout
+    """
+
+    if name not in REPORTS:
+        logging.error(f"Invalid report {name}, valid reports are {list(REPORTS)}")
+        sys.exit(1)
+
+    try:
+        columns, rows = run_report(db, name, user=user, repo=repo, against=against)
+    except (FileNotFoundError, ValueError, sqlite3.Error) as e:
+        logging.error(e)
+        sys.exit(1)
+
+    if format == 'table':
+        table = Table(*columns, title=f"{name}({len(rows)})")
+
+        for row in rows:
+            table.add_row(*["" if value is None else str(value) for value in row])
+
+        console.print(table)
+        return
+
+    fh = open(output, 'w', newline='') if output else sys.stdout
+
+    try:
+        if format == 'csv':
+            writer = csv.writer(fh)
+            writer.writerow(columns)
+            writer.writerows(rows)
+        elif format == 'json':
+            fh.write(json.dumps([dict(zip(columns, row)) for row in rows], indent=2) + "\n")
+        else:
+            logging.error(f"Invalid format {format}, use table, csv or json")
+            sys.exit(1)
+    finally:
+        if output:
+            fh.close()
@@ -1,4 +1,5 @@
 
+from gadget import transport
 from gadget.tasks import init, utils
 from invoke import task
 from atlassian import Confluence
@@ -10,10 +11,17 @@ console = Console()
 
 @task(pre=[init.load_conf])
 def init(ctx):
-    ctx.config.main.confluence.client = Confluence(
-        url='https://platformzero.atlassian.net/wiki',
-        username=ctx.config.main.confluence.username,
-        password=ctx.config.main.confluence.password,
+    username = ctx.config.main.confluence.username
+    password = ctx.config.main.confluence.password
+
+    ctx.config.main.confluence.client = utils.client_cache(
+        ('confluence', username, password),
+        lambda: Confluence(
+            url='https://platformzero.atlassian.net/wiki',
+            username=username,
+            password=password,
+            session=transport.session(),
+        )
     )
 
 
@@ -3,6 +3,7 @@ from io import BufferedIOBase
 import logging
 import time
 
+from gadget import httpcache, transport
 from gadget.tasks import init, utils, confluence
 from invoke import task, Collection, Executor
 from azure.identity import AzureCliCredential, ChainedTokenCredential, ManagedIdentityCredential
@@ -17,6 +18,8 @@ from OpenSSL import crypto
 
 console = Console()
 
+API_ROOT = 'https://www.digicert.com/services/v2'
+
 
 class OrdersResource(Resource):
     actions = {
@@ -44,15 +47,23 @@ def init(ctx, headers=dict(), params=dict()):
     headers.update(**default_headers)
     params.update(**default_params)
 
-    api = API(
-        api_root_url='https://www.digicert.com/services/v2',
-        params=params,
-        headers=headers,
-        json_encode_body=True
-    )
+    def connect():
+        api = API(
+            api_root_url=API_ROOT,
+            params=params,
+            headers=headers,
+            json_encode_body=True
+        )
+
+        api.add_resource(resource_name='orders', resource_class=OrdersResource)
+        api.add_resource(resource_name='cert', resource_class=CertResource)
 
-    api.add_resource(resource_name='orders', resource_class=OrdersResource)
-    api.add_resource(resource_name='cert', resource_class=CertResource)
+        for resource in (api.orders, api.cert):
+            resource.client = transport.httpx_client()
+
+        return api
+
+    api = utils.client_cache(('digicert', ctx.config.main.digicert.api_key), connect)
 
     ctx.config.main.digicert.api = api
 
@@ -62,12 +73,15 @@ def init_vault(ctx, vault=None):
     if vault is None:
         vault = ctx.config.main.digicert.keyvault
 
-    credential = ChainedTokenCredential(
-        ManagedIdentityCredential(), AzureCliCredential()
-    )
+    def connect():
+        credential = ChainedTokenCredential(
+            ManagedIdentityCredential(), AzureCliCredential()
+        )
+
+        return SecretClient(
+            vault_url=f"https://{vault}.vault.azure.net/", credential=credential)
 
-    client = SecretClient(
-        vault_url=f"https://{vault}.vault.azure.net/", credential=credential)
+    client = utils.client_cache(('keyvault', vault), connect)
 
     ctx.run_state.vault_client = client
 
@@ -76,8 +90,17 @@ def init_vault(ctx, vault=None):
 
 @task(pre=[init])
 def list_orders(ctx):
-    api = ctx.config.main.digicert.api
-    orders = api.orders.list(body=None, params={'filters[status]': 'issued'})
+    api_key = ctx.config.main.digicert.api_key
+    session = utils.client_cache(
+        ('digicert-session', api_key),
+        lambda: transport.session(headers={'X-DC-DEVKEY': api_key, 'Content-Type': 'application/json'})
+    )
+
+    # Read through the shared transport so the listing can be served from the http cache
+    with httpcache.policy():
+        response = session.get(f"{API_ROOT}/order/certificate", params={'filters[status]': 'issued'})
+
+    response.raise_for_status()
 
     columns = [
         "Order Id",
@@ -91,7 +114,7 @@ def list_orders(ctx):
     rows = []
 
     table = Table(*columns, title="Certificate Catalog")
-    orders_list = orders.body.get('orders')
+    orders_list = response.json().get('orders')
 
     for item in orders_list:
         console.print(item)
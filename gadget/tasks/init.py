@@ -1,6 +1,8 @@
 import yaml
 import os
 import logging
+import hashlib
+import json
 
 from gadget.tasks import utils
 from pathlib import Path
@@ -8,6 +10,82 @@ from invoke import task
 
 GADGET_CONF = "gadget"
 
+# Parsed configs keyed on (path, mtime, size), as json so every caller gets its own copy
+_snapshots = {}
+
+
+def write_snapshot(snapshot, data):
+    """
+    Writes a config snapshot readable by the user only, the config holds credentials
+
+    :param snapshot: Path, The snapshot location
+    :param data: string, The snapshot
+    """
+
+    tmp = snapshot.with_suffix(f".{os.getpid()}.tmp")
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(data)
+
+    os.replace(tmp, snapshot)
+
+
+def read_conf(config):
+    """
+    Loads a config file, reusing the snapshot parsed by an earlier run while
+    the file is unchanged. Snapshots are plain json in the 0700 cache directory.
+
+    :param config: string, Location of the config file
+    :return dict: The parsed config
+    """
+
+    path = Path(config).resolve()
+    stat = path.stat()
+    key = [path.as_posix(), stat.st_mtime_ns, stat.st_size]
+    memo = tuple(key)
+
+    if memo in _snapshots:
+        return json.loads(_snapshots[memo])
+
+    snapshot = None
+
+    try:
+        snapshot = utils.cache_dir('config').joinpath(f"{hashlib.sha1(key[0].encode('utf-8')).hexdigest()}.json")
+
+        with open(snapshot, 'r') as fh:
+            cached = json.load(fh)
+
+        if cached['key'] == key:
+            logging.debug(f"Using config snapshot {snapshot}")
+            _snapshots[memo] = json.dumps(cached['conf'])
+            return cached['conf']
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        logging.debug(f"Ignoring config snapshot: {e}")
+
+    with open(path, 'rb') as fh:
+        conf = yaml.load(fh.read(), Loader=utils.YAML_LOADER)
+
+    try:
+        data = json.dumps(conf)
+    except TypeError as e:
+        # Values json can't hold (eg: yaml dates), the config is parsed on every run
+        logging.debug(f"Not caching config {path}: {e}")
+        return conf
+
+    _snapshots[memo] = data
+
+    if snapshot is not None:
+        try:
+            write_snapshot(snapshot, json.dumps({'key': key, 'conf': conf}))
+        except OSError as e:
+            logging.debug(f"Unable to write config snapshot: {e}")
+
+    return conf
+
+
 @task()
 def load_conf(ctx, config=None):
     """ Initialize configuration with provided config or default config
@@ -31,12 +109,19 @@ def load_conf(ctx, config=None):
                 config = location.as_posix()
                 break
 
+    # Imported here so listing or describing tasks doesn't load requests and sqlite3
+    from gadget import gitignore, httpcache, mirrors, scheduler, transport
+
     try:
         logging.info(f"Loading config: {config}")
-        fh = open(config, 'rb')
-        conf = yaml.load(fh.read(), Loader=yaml.FullLoader)
+        conf = read_conf(config)
+        transport.configure(**((conf or {}).get('http') or {}))
+        scheduler.configure(**((conf or {}).get('scheduler') or {}))
+        httpcache.configure(**((conf or {}).get('http_cache') or {}))
+        gitignore.configure(**((conf or {}).get('gitignore') or {}))
+        mirrors.configure(**((conf or {}).get('mirrors') or {}))
         ctx.config.main = conf
         ctx.run_state = {}
-    except FileNotFoundError as e:
+    except (FileNotFoundError, TypeError) as e:
         logging.error(e)
         exit(1)
@@ -5,6 +5,7 @@ from invoke import task, config, call
 from atlassian import Jira
 from rich import print
 from rich.logging import RichHandler
+from gadget import transport
 
 @task()
 def init(ctx):
@@ -12,7 +13,8 @@ def init(ctx):
         url='https://platformzero.atlassian.net/rest/api/3',
         username=ctx.config.main.jira.username,
         password=ctx.config.main.jira.password,
-        cloud=True
+        cloud=True,
+        session=transport.session()
     )
 
 
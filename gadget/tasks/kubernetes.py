@@ -2,6 +2,7 @@ import logging
 
 from kubernetes import client, config
 from invoke import task
+from gadget import metrics, transport
 from gadget.tasks import init, utils, confluence
 from atlassian import Confluence
 from rich.console import Console
@@ -35,12 +36,35 @@ zones = {
 }
 
 
+def api_client(zone):
+    """
+    :param zone: string, The zone whose cluster to connect to
+    :return ApiClient: Cached api client for the zone cluster, in-cluster config when no kube context exists
+    """
+
+    def connect():
+        try:
+            return config.new_client_from_config(context=zones[zone]['cluster'])
+        except:
+            config.load_incluster_config()
+            return client.ApiClient()
+
+    return utils.client_cache(('kubernetes', zone), connect)
+
+
 @task(pre=[init.load_conf])
 def init(ctx):
-    ctx.config.main.confluence.client = Confluence(
-        url='https://platformzero.atlassian.net/wiki',
-        username=ctx.config.main.confluence.username,
-        password=ctx.config.main.confluence.password,
+    username = ctx.config.main.confluence.username
+    password = ctx.config.main.confluence.password
+
+    ctx.config.main.confluence.client = utils.client_cache(
+        ('confluence', username, password),
+        lambda: Confluence(
+            url='https://platformzero.atlassian.net/wiki',
+            username=username,
+            password=password,
+            session=transport.session(),
+        )
     )
 
 
@@ -51,11 +75,7 @@ def get_contexts(ctx):
 
 @task(pre=[init])
 def get_pods(ctx, zone):
-    try:
-        config.load_kube_config(context=zones[zone]['cluster'])
-    except:
-        config.load_incluster_config()
-    kube = client.CoreV1Api()
+    kube = client.CoreV1Api(api_client(zone))
     k8s = kube.list_pod_for_all_namespaces()
 
     columns = ["PodName", "Created", "ContainerName", "Image", "Status"]
@@ -90,13 +110,10 @@ def get_pods(ctx, zone):
 
 @task(pre=[init])
 def cleanup_jobs(ctx, zone, include_completed=False, purge=False):
-    try:
-        config.load_kube_config(context=zones[zone]['cluster'])
-    except:
-        config.load_incluster_config()
-    kube = client.BatchV1Api()
+    kube = client.BatchV1Api(api_client(zone))
     k8s = kube.list_job_for_all_namespaces()
     jobs = k8s.items
+    metrics.count('jobs_found', len(jobs))
 
     columns = ["JobName", "NameSpace", "StartTime", "EndTime", "Message"]
     table = Table(*columns, title="Jobs")
@@ -123,9 +140,11 @@ def cleanup_jobs(ctx, zone, include_completed=False, purge=False):
         for item in jobs:
             if item.status.to_dict().get('failed'):
                 action = kube.delete_namespaced_job(item.metadata.name, item.metadata.namespace)
+                metrics.count('jobs_deleted')
 
             if include_completed and item.status.to_dict().get('successful'):
                 action = kube.delete_namespaced_job(item.metadata.name, item.metadata.namespace)
+                metrics.count('jobs_deleted')
 
             logging.info(f"Deleted job {item.metadata.name}: {action}")
     else:
@@ -134,11 +153,7 @@ def cleanup_jobs(ctx, zone, include_completed=False, purge=False):
 
 @task(pre=[init])
 def audit_namespaces(ctx, zone, table=False, publish=False):
-    try:
-        config.load_kube_config(context=zones[zone]['cluster'])
-    except:
-        config.load_incluster_config()
-    kube = client.CoreV1Api()
+    kube = client.CoreV1Api(api_client(zone))
     ns = kube.list_namespace()
     columns = ["Name", "Created", "ClientId", "WorkStream", "ServiceClass", "Pods"]
     namespaces = []
@@ -201,11 +216,7 @@ def audit_namespaces(ctx, zone, table=False, publish=False):
 
 @task(pre=[init])
 def audit_deployments(ctx, zone, output=None, publish=False):
-    try:
-        config.load_kube_config(context=zones[zone]['cluster'])
-    except:
-        config.load_incluster_config()
-    kube = client.AppsV1Api()
+    kube = client.AppsV1Api(api_client(zone))
     deployments = kube.list_deployment_for_all_namespaces()
     columns = ["NameSpace", "Name", "Status", "ImageName", "ImageUrl"]
     console_table = Table(*columns, title="Active Pods")
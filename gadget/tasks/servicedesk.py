@@ -7,6 +7,7 @@ from rich import print
 from rich.logging import RichHandler
 from rich.console import Console
 from rich.table import Table
+from gadget import transport
 from gadget.tasks import init, utils
 
 # table = Table(title="Star Wars Movies")
@@ -24,11 +25,18 @@ logger = logging.getLogger("rich")
 
 @task(pre=[init.load_conf])
 def init(ctx):
-    client = ServiceDesk(
-        url='https://platformzero.atlassian.net',
-        username=ctx.config.main.servicedesk.username,
-        password=ctx.config.main.servicedesk.password,
-        cloud=True
+    username = ctx.config.main.servicedesk.username
+    password = ctx.config.main.servicedesk.password
+
+    client = utils.client_cache(
+        ('servicedesk', username, password),
+        lambda: ServiceDesk(
+            url='https://platformzero.atlassian.net',
+            username=username,
+            password=password,
+            cloud=True,
+            session=transport.session()
+        )
     )
 
     ctx.run_state.servicedesk = client
@@ -2,6 +2,7 @@ import logging
 import json
 import os
 
+from gadget import httpcache, transport
 from gadget.tasks import init, utils
 from datetime import datetime
 from invoke import task
@@ -15,14 +16,49 @@ console = Console()
 
 print("Hello from Terraform")
 
+TFC_URL = 'https://app.terraform.io'
+ORGANIZATION = 'platformzero'
+
+
+def list_all(ctx, path):
+    """
+    Fetches every page of a TFC listing through the shared, cached transport
+
+    :param path: string, The api path (eg: /organizations/{org}/workspaces)
+    :return list: The `data` items of every page
+    """
+
+    token = ctx.config.main.terraform.token
+    session = utils.client_cache(
+        ('terraform-session', token),
+        lambda: transport.session(
+            headers={'Authorization': f"Bearer {token}", 'Content-Type': 'application/vnd.api+json'}
+        )
+    )
+
+    results = []
+    page = 1
+
+    with httpcache.policy():
+        while page:
+            response = session.get(f"{TFC_URL}/api/v2{path}", params={'page[number]': page, 'page[size]': 100})
+            response.raise_for_status()
+            body = response.json()
+
+            results.extend(body['data'])
+            page = body.get('meta', {}).get('pagination', {}).get('next-page')
+
+    return results
+
+
 @task(pre=[init.load_conf])
 def init(ctx):
     client = TFC(
         ctx.config.main.terraform.token,
-        url='https://app.terraform.io'
+        url=TFC_URL
     )
 
-    client.set_org('platformzero')
+    client.set_org(ORGANIZATION)
 
     ctx.run_state.tfc = client
     return client
@@ -30,9 +66,7 @@ def init(ctx):
 
 @task(pre=[init])
 def list_workspaces(ctx):
-    api = init(ctx)
-
-    workspaces = api.workspaces.list_all()
+    workspaces = list_all(ctx, f"/organizations/{ORGANIZATION}/workspaces")
 
     # console.print(workspaces)
 
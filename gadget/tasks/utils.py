@@ -1,10 +1,114 @@
 import types
 import random, string, logging, os
 import json
+import re
+import sys
+import threading
 import yaml
 
+from pathlib import Path
 from invoke import task, config
 
+CACHE_HOME = Path(os.environ.get('GADGET_CACHE_DIR', '~/.cache/gadget')).expanduser()
+
+# libyaml backed loader when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+
+
+# Authenticated clients kept for the life of the process (see `gadget serve`)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def client_cache(key, factory):
+    """
+    :param key: tuple, Identifies the client, should include the credentials used
+    :param factory: callable, Creates the client when it is not cached yet
+    :return: The cached client
+    """
+
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = factory()
+
+        return _clients[key]
+
+
+def cache_dir(*parts):
+    """
+    :param parts: Path components below the gadget cache directory
+    :return Path: The cache directory, created if missing and only accessible by the user
+    """
+
+    CACHE_HOME.mkdir(mode=0o700, parents=True, exist_ok=True)
+    path = CACHE_HOME.joinpath(*parts)
+    path.mkdir(mode=0o700, parents=True, exist_ok=True)
+    return path
+
+
+def write_ndjson(records, fh=None):
+    """
+    Writes records as newline delimited json as they arrive
+
+    :param records: iterable, The records to write
+    :param fh: file, Defaults to stdout
+    :return int: Number of records written
+    """
+
+    fh = fh or sys.stdout
+    count = 0
+
+    for record in records:
+        fh.write(f"{json.dumps(record)}\n")
+        count += 1
+
+        if count % 100 == 0:
+            fh.flush()
+
+    fh.flush()
+    return count
+
+
+# Whitespace and json array punctuation between records
+RECORD_SEPARATORS = re.compile(r'[\s\[\],]*')
+
+
+def read_records(path, chunk_size=1024 * 1024):
+    """
+    Reads the records of a newline delimited json file, or of a json array
+    (the older results.json), one at a time without loading the whole file
+
+    :param path: string, Location of the file
+    :param chunk_size: int, Characters read at a time
+    :return generator: The records
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    pos = 0
+    eof = False
+
+    with open(path, 'r') as fh:
+        while True:
+            pos = RECORD_SEPARATORS.match(buffer, pos).end()
+
+            if pos < len(buffer):
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    if eof:
+                        raise
+                else:
+                    yield record
+                    continue
+            elif eof:
+                return
+
+            chunk = fh.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
 
 def objectify(hash):
     return types.SimpleNamespace(**hash)
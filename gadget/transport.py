@@ -0,0 +1,211 @@
+import importlib.util
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+from gadget import httpcache, metrics, scheduler
+
+#
+# Process wide HTTP transport. Every service client gets its own session for
+# auth, headers and cookies, but all sessions share one adapter and therefore
+# one set of keep-alive connection pools per host.
+#
+settings = {
+    'pool_connections': int(os.environ.get('GADGET_HTTP_POOL_CONNECTIONS', 10)),
+    'pool_size': int(os.environ.get('GADGET_HTTP_POOL_SIZE', 20)),
+    'http2': os.environ.get('GADGET_HTTP2', '1') != '0',
+}
+
+_lock = threading.Lock()
+_adapter = None
+_httpx_client = None
+
+# Responses that are retried after waiting, when the server asks for it
+THROTTLED = (429, 503)
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    Takes a token from the host bucket before every request and backs off
+    and retries when the server answers 429 (or 503 with Retry-After).
+    GET requests made under an httpcache policy go through the response cache.
+    """
+
+    def send(self, request, **kwargs):
+        ttl = httpcache.active() if request.method == 'GET' and not kwargs.get('stream') else None
+
+        if ttl is not None:
+            return httpcache.fetch(request, ttl, lambda: self.send_limited(request, **kwargs))
+
+        return self.send_limited(request, **kwargs)
+
+    def send_limited(self, request, **kwargs):
+        bucket = scheduler.bucket(urlparse(request.url).hostname)
+        # Streamed bodies (file uploads) can't be replayed
+        replayable = request.body is None or isinstance(request.body, (bytes, str))
+        sent = len(request.body) if replayable and request.body else 0
+        start = time.perf_counter()
+        attempt = 0
+
+        while True:
+            if bucket is not None:
+                bucket.acquire()
+
+            try:
+                response = super(RateLimitedAdapter, self).send(request, **kwargs)
+            except requests.exceptions.RequestException:
+                metrics.record_request(request.url, time.perf_counter() - start, sent=sent, retries=attempt)
+                raise
+
+            throttled = response.status_code == 429 or (
+                response.status_code in THROTTLED and 'Retry-After' in response.headers
+            )
+
+            if not throttled or not replayable or attempt >= scheduler.settings['retries']:
+                metrics.record_request(
+                    request.url, time.perf_counter() - start, response.status_code,
+                    sent=sent, received=int(response.headers.get('Content-Length') or 0), retries=attempt
+                )
+
+            if not throttled:
+                if bucket is not None:
+                    bucket.recover()
+                return response
+
+            delay = scheduler.retry_after(response.headers, attempt)
+
+            if bucket is not None:
+                bucket.throttle(delay)
+
+            if not replayable or attempt >= scheduler.settings['retries']:
+                return response
+
+            attempt += 1
+            logging.info(f"{response.status_code} from {request.url}, retry {attempt} in {delay:.1f}s")
+            response.close()
+
+            if bucket is None:
+                time.sleep(delay)
+
+
+def configure(pool_connections=None, pool_size=None, http2=None):
+    """
+    Updates the transport settings, usually from the `http` section of gadget.yaml
+
+    :param pool_connections: int, Number of per host pools to keep
+    :param pool_size: int, Max keep-alive connections per host
+    :param http2: bool, Negotiate HTTP/2 on clients that support it
+    """
+
+    global _adapter, _httpx_client
+
+    overrides = dict(pool_connections=pool_connections, pool_size=pool_size, http2=http2)
+
+    with _lock:
+        updated = dict(settings, **{key: value for key, value in overrides.items() if value is not None})
+
+        # Called before every task, keep the pooled connections unless the settings change
+        if updated == settings:
+            return
+
+        settings.update(updated)
+        old_adapter, old_client = _adapter, _httpx_client
+        _adapter = None
+        _httpx_client = None
+
+    if old_adapter is not None:
+        old_adapter.close()
+    if old_client is not None:
+        old_client.close()
+
+
+def adapter():
+    """
+    :return HTTPAdapter: The shared requests adapter
+    """
+
+    global _adapter
+
+    with _lock:
+        if _adapter is None:
+            logging.debug(f"Creating HTTP adapter: {settings}")
+            _adapter = RateLimitedAdapter(
+                pool_connections=settings['pool_connections'],
+                pool_maxsize=settings['pool_size'],
+            )
+
+        return _adapter
+
+
+def session(auth=None, headers=None):
+    """
+    :param auth: tuple|AuthBase, Optional auth for the session
+    :param headers: dict, Optional default headers
+    :return requests.Session: A session backed by the shared connection pools
+    """
+
+    s = requests.Session()
+    shared = adapter()
+    s.mount('https://', shared)
+    s.mount('http://', shared)
+
+    if auth is not None:
+        s.auth = auth
+    if headers:
+        s.headers.update(headers)
+
+    return s
+
+
+def httpx_client():
+    """
+    Shared httpx client for the simple_rest_client based APIs (DigiCert).
+    HTTP/2 is negotiated when the h2 package is installed.
+
+    :return httpx.Client: The shared client
+    """
+
+    global _httpx_client
+
+    import httpx
+
+    with _lock:
+        if _httpx_client is None:
+            http2 = settings['http2'] and importlib.util.find_spec('h2') is not None
+
+            def acquire(request):
+                limiter = scheduler.bucket(request.url.host)
+
+                if limiter is not None:
+                    limiter.acquire()
+
+                request.extensions['gadget_started'] = time.perf_counter()
+
+            def throttle(response):
+                request = response.request
+                metrics.record_request(
+                    request.url, time.perf_counter() - request.extensions.get('gadget_started', time.perf_counter()),
+                    response.status_code, sent=int(request.headers.get('Content-Length') or 0),
+                    received=int(response.headers.get('Content-Length') or 0)
+                )
+
+                limiter = scheduler.bucket(request.url.host)
+
+                if limiter is not None and response.status_code == 429:
+                    limiter.throttle(scheduler.retry_after(response.headers, 0))
+
+            _httpx_client = httpx.Client(
+                http2=http2,
+                event_hooks={'request': [acquire], 'response': [throttle]},
+                limits=httpx.Limits(
+                    max_keepalive_connections=settings['pool_size'],
+                    max_connections=settings['pool_size'] * settings['pool_connections'],
+                ),
+            )
+
+        return _httpx_client
@@ -29,7 +29,7 @@ setup(
     packages=['gadget', 'gadget/tasks'],
 
     package_data={
-        'gadget': ['version.txt'],
+        'gadget': ['version.txt', 'templates/gitignore/*.gitignore'],
     },
 
     url='https://bitbucket.org/capcosaas/pz-gadget.git',
@@ -67,7 +67,7 @@ setup(
     },
 
     entry_points={
-        'console_scripts': ['gadget = gadget.main:program.run']
+        'console_scripts': ['gadget = gadget.client:main']
     },
 
 )